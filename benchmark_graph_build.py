@@ -0,0 +1,73 @@
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+import os
+import time
+import tempfile
+import numpy as np
+# suppresses logging of loading libcublas libraries
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+# suppress tf1 deprecation warnings
+tf.logging.set_verbosity(tf.logging.ERROR)
+from lfads_tf1.run_lfads_tf1 import FLAGS, build_hyperparameter_dict, hps_dict_to_obj
+from lfads_tf1.lfads_wrapper.lfads_wrapper import lfadsWrapper
+from lfads_tf1.models import LFADS
+from lfads_tf1.data_funcs import write_data
+
+# times building the LFADS graph for a sweep of the number of sessions (ndatasets),
+#  with per-session ('case') and stacked read-in/read-out parameters (hps.session_params)
+# reports the build time, the number of ops in the graph and the time to initialize it
+
+ndatasets_sweep = [1, 10, 50, 100, 200]
+n_trials = 20
+n_steps = 50
+
+work_dir = tempfile.mkdtemp()
+rng = np.random.RandomState(0)
+
+hps_dict = build_hyperparameter_dict(FLAGS)
+hps_dict.update({
+    'data_filename_stem': 'lfads',
+    'gen_dim': 64,
+    'con_dim': 64,
+    'ic_enc_dim': 64,
+    'ci_enc_dim': 64,
+    'factors_dim': 8,
+    'in_factors_dim': 8,
+    'co_dim': 1,
+    'batch_size': 10,
+    'valid_batch_size': 10,
+    'device': 'cpu:0',
+})
+
+for ndatasets in ndatasets_sweep:
+    data_dir = os.path.join(work_dir, 'lfads_input_%d' % ndatasets)
+    for d in range(ndatasets):
+        # sessions with different channel counts
+        n_neurons = 30 + d % 20
+        write_data(os.path.join(data_dir, 'lfads_session%03d' % d),
+                   {'train_data': rng.poisson(0.5, (n_trials, n_steps, n_neurons)).astype(np.float32),
+                    'valid_data': rng.poisson(0.5, (n_trials // 4, n_steps, n_neurons)).astype(np.float32)})
+    hps_dict['data_dir'] = data_dir
+
+    for session_params in ['case', 'stacked']:
+        hps_dict['session_params'] = session_params
+        hps_dict['lfads_save_dir'] = os.path.join(work_dir, 'lfads_output_%d_%s' % (ndatasets, session_params))
+        os.makedirs(hps_dict['lfads_save_dir'])
+        hps = hps_dict_to_obj(hps_dict)
+        lfads = lfadsWrapper()
+        lfads.load_datasets_if_necessary(hps)
+        hps = lfads.infer_dataset_properties(hps)
+
+        tf.reset_default_graph()
+        with tf.Session() as sess:
+            start = time.time()
+            with tf.device(hps.device):
+                with tf.variable_scope("LFADS"):
+                    model = LFADS(hps, datasets=lfads.datasets)
+            build_time = time.time() - start
+            n_ops = len(tf.get_default_graph().get_operations())
+            start = time.time()
+            sess.run(tf.global_variables_initializer())
+            init_time = time.time() - start
+        print('ndatasets=%d, session_params=%s: build %.1f s, %d ops, init %.2f s' %
+              (ndatasets, session_params, build_time, n_ops, init_time))
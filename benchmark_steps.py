@@ -0,0 +1,77 @@
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+import os
+import time
+import tempfile
+import numpy as np
+# suppresses logging of loading libcublas libraries
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+# suppress tf1 deprecation warnings
+tf.logging.set_verbosity(tf.logging.ERROR)
+from lfads_tf1.run_lfads_tf1 import FLAGS, build_hyperparameter_dict, hps_dict_to_obj
+from lfads_tf1.lfads_wrapper.lfads_wrapper import lfadsWrapper
+from lfads_tf1.data_funcs import write_data
+
+# times training/validation epochs with steps run through session.run and
+#  through the cached Session.make_callable's (hps.use_step_callables)
+# small models are where the per-step overhead shows, as in our gen_dim 64-128 runs
+
+n_epochs = 5
+n_trials = 1000
+n_steps = 50
+n_neurons = 50
+
+work_dir = tempfile.mkdtemp()
+data_dir = os.path.join(work_dir, 'lfads_input')
+rng = np.random.RandomState(0)
+write_data(os.path.join(data_dir, 'lfads_bench'),
+           {'train_data': rng.poisson(0.5, (n_trials, n_steps, n_neurons)).astype(np.float32),
+            'valid_data': rng.poisson(0.5, (n_trials // 4, n_steps, n_neurons)).astype(np.float32)})
+
+hps_dict = build_hyperparameter_dict(FLAGS)
+hps_dict.update({
+    'data_dir': data_dir,
+    'data_filename_stem': 'lfads',
+    'gen_dim': 64,
+    'con_dim': 64,
+    'ic_enc_dim': 64,
+    'ci_enc_dim': 64,
+    'factors_dim': 8,
+    'co_dim': 1,
+    'batch_size': 50,
+    'valid_batch_size': 50,
+    'cv_keep_ratio': 0.9,
+    'device': 'cpu:0',
+})
+
+for use_step_callables in [False, True]:
+    hps_dict['use_step_callables'] = use_step_callables
+    hps_dict['lfads_save_dir'] = os.path.join(work_dir, 'lfads_output_%d' % use_step_callables)
+    hps = hps_dict_to_obj(hps_dict)
+    lfads = lfadsWrapper()
+    lfads.load_datasets_if_necessary(hps)
+    hps = lfads.infer_dataset_properties(hps)
+
+    tf.reset_default_graph()
+    sess = tf.Session()
+    with sess.as_default():
+        with tf.device(hps.device):
+            model = lfads.build_model(hps, datasets=lfads.datasets)
+        n_train_steps = model.get_num_steps_per_epoch(lfads.datasets, 'train')
+        n_valid_steps = model.get_num_steps_per_epoch(lfads.datasets, 'valid')
+        # the first epoch includes making the callables, time it separately
+        for epoch in range(n_epochs + 1):
+            start = time.time()
+            model.train_epoch(lfads.datasets, False, 1.0, 1.0, 1.0, 1.0)
+            train_time = time.time() - start
+            start = time.time()
+            model.do_validation(lfads.datasets, 1.0, 1.0, 'valid', 1.0, 1.0)
+            valid_time = time.time() - start
+            if epoch == 0:
+                train_times, valid_times = [], []
+                continue
+            train_times.append(train_time / n_train_steps)
+            valid_times.append(valid_time / n_valid_steps)
+    sess.close()
+    print('use_step_callables=%s: train step %.2f ms, valid step %.2f ms (median of %d epochs)' %
+          (use_step_callables, 1000 * np.median(train_times), 1000 * np.median(valid_times), n_epochs))
@@ -1,9 +1,10 @@
 import tensorflow.compat.v1 as tf
 tf.disable_v2_behavior()
 from tensorflow.python.ops.rnn_cell_impl import LayerRNNCell
-from lfads_tf1.helper_funcs import linear, kind_dict
+from lfads_tf1.helper_funcs import linear, kind_dict, init_linear_transform
 from lfads_tf1.helper_funcs import DiagonalGaussianFromExisting
 import numpy as np
+import collections
 
 from tensorflow.python.layers import base as base_layer
 from tensorflow.python.ops import array_ops
@@ -14,6 +15,10 @@ from tensorflow.python.ops import nn_ops
 _BIAS_VARIABLE_NAME = "bias"
 _WEIGHTS_VARIABLE_NAME = "kernel"
 
+# ComplexCell state (and output) when state_is_tuple=True
+ComplexCellStateTuple = collections.namedtuple(
+    "ComplexCellStateTuple", ("gen", "con", "co_mean", "co_logvar", "co_out", "factors"))
+
 
 class GRUCell(LayerRNNCell):
     """Gated Recurrent Unit cell (cf. http://arxiv.org/abs/1406.1078).
@@ -54,6 +59,8 @@ class GRUCell(LayerRNNCell):
         self._bias_initializer = bias_initializer
         self._rec_collections = recurrent_collections
         self._clip_value = clip_value
+        # set by project_inputs, the cell then takes projected inputs
+        self._inputs_projected = False
 
     @property
     def state_size(self):
@@ -122,14 +129,34 @@ class GRUCell(LayerRNNCell):
             tf.add_to_collection(self._rec_collections, self._gate_kernel_rec)
             tf.add_to_collection(self._rec_collections, self._candidate_kernel_rec)
 
+    def project_inputs(self, inputs):
+        """Project a [batch, time, input_depth] sequence by the input kernels (and
+        biases) for all timesteps with one matmul, building the cell if needed.
+        The cell then expects these projections as its inputs, so the recurrence
+        only does the matmuls on the state.
+        """
+        if not self.built:
+            self.build(tf.TensorShape([None, inputs.get_shape()[-1].value]))
+        kernel_input = tf.concat([self._gate_kernel_input,
+                                  self._candidate_kernel_input], axis=1)
+        bias = tf.concat([self._gate_bias, self._candidate_bias], axis=0)
+        self._inputs_projected = True
+        return tf.tensordot(inputs, kernel_input, axes=1) + bias
+
     def call(self, inputs, state):
         """Gated recurrent unit (GRU) with nunits cells."""
-        # MRK, seperate matmul for input and recurrent weights
-        gate_inputs_input = math_ops.matmul(inputs, self._gate_kernel_input)
-        gate_inputs_rec = math_ops.matmul(state, self._gate_kernel_rec)
-        gate_inputs = gate_inputs_input + gate_inputs_rec
+        if self._inputs_projected:
+            # input matmuls and biases were done for the whole sequence
+            gate_inputs_input, candidate_input = array_ops.split(
+                inputs, [2 * self._num_units, self._num_units], axis=1)
+            gate_inputs = gate_inputs_input + math_ops.matmul(state, self._gate_kernel_rec)
+        else:
+            # MRK, seperate matmul for input and recurrent weights
+            gate_inputs_input = math_ops.matmul(inputs, self._gate_kernel_input)
+            gate_inputs_rec = math_ops.matmul(state, self._gate_kernel_rec)
+            gate_inputs = gate_inputs_input + gate_inputs_rec
 
-        gate_inputs = nn_ops.bias_add(gate_inputs, self._gate_bias)
+            gate_inputs = nn_ops.bias_add(gate_inputs, self._gate_bias)
 
         value = math_ops.sigmoid(gate_inputs)
         r, u = array_ops.split(value=value, num_or_size_splits=2, axis=1)
@@ -139,12 +166,15 @@ class GRUCell(LayerRNNCell):
         # candidate = math_ops.matmul(
         #    array_ops.concat([inputs, r_state], 1), self._candidate_kernel)
 
-        # MRK, seperate matmul for input and recurrent weights
-        candidate_input = math_ops.matmul(inputs, self._candidate_kernel_input)
-        candidate_rec = math_ops.matmul(r_state, self._candidate_kernel_rec)
-        candidate = candidate_input + candidate_rec
+        if self._inputs_projected:
+            candidate = candidate_input + math_ops.matmul(r_state, self._candidate_kernel_rec)
+        else:
+            # MRK, seperate matmul for input and recurrent weights
+            candidate_input = math_ops.matmul(inputs, self._candidate_kernel_input)
+            candidate_rec = math_ops.matmul(r_state, self._candidate_kernel_rec)
+            candidate = candidate_input + candidate_rec
 
-        candidate = nn_ops.bias_add(candidate, self._candidate_bias)
+            candidate = nn_ops.bias_add(candidate, self._candidate_bias)
 
         c = self._activation(candidate)
         new_h = u * state + (1 - u) * c
@@ -169,6 +199,17 @@ class ComplexCell(LayerRNNCell):
         cases.
       dtype: Default dtype of the layer (default of `None` means use the type
         of the first input). Required when `build` is called before `call`.
+      do_posterior_sample: If None, whether the controller output is sampled
+        from its posterior or is the posterior mean is picked at every step
+        from run_type. If True or False, the cell is built to always sample
+        (or to pass the mean, with no noise drawn), and run_type is not used.
+      state_is_tuple: If True, the state and output are a ComplexCellStateTuple
+        of the gen, con, co_mean, co_logvar, co_out and factors parts, which
+        dynamic_rnn carries as they are. The controller then reuses the
+        factors carried in the state, so the initial state's factors must be
+        gen_2_fac of its generator state (as LFADS builds it). If False, they
+        are concatenated into (and split from) one tensor every step, and the
+        factors are recomputed from the generator state every step.
     """
 
     def __init__(self,
@@ -186,7 +227,9 @@ class ComplexCell(LayerRNNCell):
                  kernel_initializer=None,
                  bias_initializer=None,
                  name=None,
-                 dtype=tf.float32):
+                 dtype=tf.float32,
+                 do_posterior_sample=None,
+                 state_is_tuple=False):
         super(ComplexCell, self).__init__(_reuse=reuse, name=name, dtype=dtype)
 
         # Inputs must be 2-dimensional.
@@ -211,15 +254,27 @@ class ComplexCell(LayerRNNCell):
         self._ext_input_dim = ext_input_dim
         self._keep_prob = keep_prob
         self._clip_value = clip_value
+        self._do_posterior_sample = do_posterior_sample
+        self._state_is_tuple = state_is_tuple
+        # set by project_con_inputs, the cell then takes projected controller inputs
+        self._con_inputs_projected = False
+        self._gate_kernel_input_rest = {}
+        self._candidate_kernel_input_rest = {}
+        # set by draw_noise, the sizes of the random inputs appended to the inputs
+        self._noise_dims = None
 
 
     @property
     def state_size(self):
+        if self._state_is_tuple:
+            return ComplexCellStateTuple(self._num_units_gen, self._num_units_con,
+                                         self._co_dim, self._co_dim, self._co_dim,
+                                         self._factors_dim)
         return self._num_units_con + self._num_units_gen + 3 * self._co_dim + self._factors_dim
 
     @property
     def output_size(self):
-        return self._num_units_con + self._num_units_gen + 3 * self._co_dim + self._factors_dim
+        return self.state_size
 
     def build(self, inputs_shape):
         # create GRU weight/bias tensors for generator and controller
@@ -241,6 +296,24 @@ class ComplexCell(LayerRNNCell):
                               rec_collections_name='l2_con',
                               input_initializer=input_initializer, rec_initializer=rec_initializer,
                               bias_initializer=self._bias_initializer)
+
+        # the linear transforms used in call, created here (rather than in the
+        #  first call) so that all the cell's variables exist once it is built
+        with tf.variable_scope("gen_2_fac"):
+            # MRK, make do_bias=False, and normalized the factors
+            # (normalized here, i.e. once per sequence when the cell is built before the loop)
+            self._gen_2_fac_W, _ = init_linear_transform(self._num_units_gen, self._factors_dim,
+                                                         name="gen_2_fac_transform",
+                                                         do_bias=False,
+                                                         normalized=True)
+        if self._co_dim > 0:
+            # transformation to mean and logvar of the posterior
+            self._con_2_gen_mean_W, self._con_2_gen_mean_b = \
+                init_linear_transform(self._num_units_con, self._co_dim,
+                                      name="con_2_gen_transform_mean")
+            self._con_2_gen_logvar_W, self._con_2_gen_logvar_b = \
+                init_linear_transform(self._num_units_con, self._co_dim,
+                                      name="con_2_gen_transform_logvar")
         self.built = True
 
     def build_custom(self, input_depth, cell_name='', num_units=None, rec_collections_name=None,
@@ -286,26 +359,132 @@ class ComplexCell(LayerRNNCell):
             tf.add_to_collection(rec_collections_name, self._gate_kernel_rec[cell_name])
             tf.add_to_collection(rec_collections_name, self._candidate_kernel_rec[cell_name])
 
-    def gru_block(self, inputs, state, cell_name=''):
-        """Gated recurrent unit (GRU) with nunits cells."""
-        # MRK, seperate matmul for input and recurrent weights
-        gate_inputs_input = math_ops.matmul(inputs, self._gate_kernel_input[cell_name])
-        gate_inputs_rec = math_ops.matmul(state, self._gate_kernel_rec[cell_name])
-        gate_inputs = gate_inputs_input + gate_inputs_rec
+    def project_con_inputs(self, inputs):
+        """Project the controller inputs (con_i, i.e. the [batch, time, depth]
+        inputs without the external inputs) by the matching rows of the
+        controller's input kernels, with biases, for all timesteps at once. The
+        dropout on con_i is applied here as well. The cell then expects these
+        projections in place of con_i, and per step only multiplies the factors
+        and the recurrent state.
+        """
+        if not self.built:
+            # build in the layer's own scope, as the first call would
+            self._set_scope(None)
+            with tf.variable_scope(self._scope, auxiliary_name_scope=False):
+                self.build(tf.TensorShape([None, inputs.get_shape()[-1].value]))
+        if self._co_dim == 0:
+            # no controller, nothing to project
+            return inputs
+
+        if self._ext_input_dim > 0:
+            ext_inputs = inputs[:, :, -self._ext_input_dim:]
+            con_i = inputs[:, :, :-self._ext_input_dim]
+        else:
+            con_i = inputs
+        con_i = tf.nn.dropout(con_i, self._keep_prob)
+        con_i_depth = con_i.get_shape()[-1].value
+
+        # con inputs are concat([con_i, fac_s]), so the first rows of the
+        #  kernels are for con_i and the rest for the factors
+        cell_name = 'con_gru'
+        kernel_input = tf.concat([self._gate_kernel_input[cell_name][:con_i_depth],
+                                  self._candidate_kernel_input[cell_name][:con_i_depth]], axis=1)
+        bias = tf.concat([self._gate_bias[cell_name], self._candidate_bias[cell_name]], axis=0)
+        self._gate_kernel_input_rest[cell_name] = self._gate_kernel_input[cell_name][con_i_depth:]
+        self._candidate_kernel_input_rest[cell_name] = self._candidate_kernel_input[cell_name][con_i_depth:]
+        self._con_inputs_projected = True
+
+        con_i_projected = tf.tensordot(con_i, kernel_input, axes=1) + bias
+        if self._ext_input_dim > 0:
+            return tf.concat([con_i_projected, ext_inputs], axis=2)
+        return con_i_projected
+
+    def draw_noise(self, inputs):
+        """Draw the dropout masks and the controller output noise that the cell
+        would draw at every step, for all timesteps of the [batch, time, depth]
+        inputs at once, and append them to the inputs. The cell then takes them
+        from its inputs and draws no random numbers in the loop. The draws are
+        i.i.d. as in the loop. Call after project_con_inputs, if that is used.
+        With state_is_tuple False, the factors the cell recomputes from its
+        incoming state still get their dropout mask drawn in the loop.
+        """
+        batch_size, num_steps = tf.unstack(tf.shape(inputs)[:2])
+        self._noise_dims = collections.OrderedDict()
+        if not (isinstance(self._keep_prob, (int, float)) and self._keep_prob == 1):
+            if self._co_dim > 0:
+                # the controller inputs are the factors (and con_i, unless projected)
+                self._noise_dims['con_drop'] = self._factors_dim if self._con_inputs_projected else \
+                    inputs.get_shape()[-1].value - self._ext_input_dim + self._factors_dim
+            self._noise_dims['gen_drop'] = self._num_units_gen
+        if self._co_dim > 0 and self._do_posterior_sample is not False:
+            self._noise_dims['co_noise'] = self._co_dim
+
+        noise = []
+        for name, dim in self._noise_dims.items():
+            shape = tf.stack([batch_size, num_steps, dim])
+            if name == 'co_noise':
+                noise.append(tf.random_normal(shape))
+            else:
+                # the mask tf.nn.dropout applies, with the 1/keep_prob scaling
+                noise.append(tf.floor(self._keep_prob + tf.random_uniform(shape)) / self._keep_prob)
+            # (keep_prob may have no static shape)
+            noise[-1].set_shape([None, None, dim])
+        return tf.concat([inputs] + noise, axis=2)
+
+    def dropout(self, x, mask=None):
+        # the cell's dropout, with a mask drawn before the loop if given (see draw_noise)
+        if mask is None:
+            return tf.nn.dropout(x, self._keep_prob)
+        return x * mask
+
+    def gen_2_fac(self, gen_s, dropout_mask=None):
+        """Factors from a generator state. With state_is_tuple the cell
+        carries the factors in its state, so the initial state should hold
+        gen_2_fac of the initial generator state.
+        """
+        with tf.name_scope("gen_2_fac"):
+            # add dropout to gen output (MRK fix)
+            gen_s_dropped = self.dropout(gen_s, dropout_mask)
+            return tf.matmul(gen_s_dropped, self._gen_2_fac_W)
+
+    def gru_block(self, inputs, state, cell_name='', projected_inputs=None):
+        """Gated recurrent unit (GRU) with nunits cells.
+
+        If projected_inputs is given, it holds the gate and candidate
+        pre-activations (biases included) of the inputs projected before the
+        loop, and inputs are the remaining ones (see project_con_inputs).
+        """
+        if projected_inputs is not None:
+            num_units = self._candidate_bias[cell_name].get_shape()[0].value
+            gate_inputs_proj, candidate_proj = array_ops.split(
+                projected_inputs, [2 * num_units, num_units], axis=1)
+            gate_inputs = gate_inputs_proj + \
+                math_ops.matmul(inputs, self._gate_kernel_input_rest[cell_name]) + \
+                math_ops.matmul(state, self._gate_kernel_rec[cell_name])
+        else:
+            # MRK, seperate matmul for input and recurrent weights
+            gate_inputs_input = math_ops.matmul(inputs, self._gate_kernel_input[cell_name])
+            gate_inputs_rec = math_ops.matmul(state, self._gate_kernel_rec[cell_name])
+            gate_inputs = gate_inputs_input + gate_inputs_rec
 
-        gate_inputs = nn_ops.bias_add(gate_inputs, self._gate_bias[cell_name])
+            gate_inputs = nn_ops.bias_add(gate_inputs, self._gate_bias[cell_name])
 
         value = math_ops.sigmoid(gate_inputs)
         r, u = array_ops.split(value=value, num_or_size_splits=2, axis=1)
 
         r_state = r * state
 
-        # MRK, separate matmul for input and recurrent weights
-        candidate_input = math_ops.matmul(inputs, self._candidate_kernel_input[cell_name])
-        candidate_rec = math_ops.matmul(r_state, self._candidate_kernel_rec[cell_name])
-        candidate = candidate_input + candidate_rec
+        if projected_inputs is not None:
+            candidate = candidate_proj + \
+                math_ops.matmul(inputs, self._candidate_kernel_input_rest[cell_name]) + \
+                math_ops.matmul(r_state, self._candidate_kernel_rec[cell_name])
+        else:
+            # MRK, separate matmul for input and recurrent weights
+            candidate_input = math_ops.matmul(inputs, self._candidate_kernel_input[cell_name])
+            candidate_rec = math_ops.matmul(r_state, self._candidate_kernel_rec[cell_name])
+            candidate = candidate_input + candidate_rec
 
-        candidate = nn_ops.bias_add(candidate, self._candidate_bias[cell_name])
+            candidate = nn_ops.bias_add(candidate, self._candidate_bias[cell_name])
 
         c = self._activation(candidate)
         new_h = u * state + (1 - u) * c
@@ -314,6 +493,14 @@ class ComplexCell(LayerRNNCell):
         return new_h
 
     def call(self, inputs, state):
+        # split off the random inputs drawn before the loop, if any
+        noise = {}
+        if self._noise_dims:
+            noise_names = list(self._noise_dims)
+            splits = array_ops.split(inputs, [-1] + [self._noise_dims[n] for n in noise_names], axis=1)
+            inputs = splits[0]
+            noise = dict(zip(noise_names, splits[1:]))
+
         # if external inputs are used split the inputs
         if self._ext_input_dim > 0:
             ext_inputs = inputs[:, -self._ext_input_dim:]
@@ -322,48 +509,57 @@ class ComplexCell(LayerRNNCell):
             con_i = inputs
 
         # split the state to get the gen and con states, and factors
-        gen_s, con_s, _, _, _, _ = \
-            tf.split(state, [self._num_units_gen,
-                             self._num_units_con,
-                             self._co_dim,
-                             self._co_dim,
-                             self._co_dim,
-                             self._factors_dim], axis=1)
-
-        with tf.variable_scope("gen_2_fac"):
-            # add dropout to gen output (MRK fix)
-            gen_s_new_dropped = tf.nn.dropout(gen_s, self._keep_prob)
-            # MRK, make do_bias=False, and normalized the factors
-            fac_s = linear(gen_s_new_dropped, self._factors_dim,
-                               name="gen_2_fac_transform",
-                               do_bias=False,
-                               normalized=True,
-                               # collections=self.col_names['fac']
-                               )
+        if self._state_is_tuple:
+            # the factors of the previous step, reused rather than recomputed
+            gen_s, con_s, _, _, _, fac_s = state
+        else:
+            gen_s, con_s, _, _, _, _ = \
+                tf.split(state, [self._num_units_gen,
+                                 self._num_units_con,
+                                 self._co_dim,
+                                 self._co_dim,
+                                 self._co_dim,
+                                 self._factors_dim], axis=1)
+            # recompute the factors from the generator state, so that any
+            #  initial state works (its factors part is ignored)
+            fac_s = self.gen_2_fac(gen_s)
         # input to the controller is (enc_con output and factors)
         if self._co_dim > 0:
             # if controller is used
-            con_inputs = tf.concat([con_i, fac_s], axis=1, )
-            # controller GRU recursion, get new state
-            # add dropout to controller inputs (MRK fix)
-            con_inputs = tf.nn.dropout(con_inputs, self._keep_prob)
-            con_s_new = self.gru_block(con_inputs, con_s, cell_name='con_gru')
+            if self._con_inputs_projected:
+                # con_i was dropped out and projected before the loop, only
+                #  the factors are multiplied here
+                con_inputs = self.dropout(fac_s, noise.get('con_drop'))
+                con_s_new = self.gru_block(con_inputs, con_s, cell_name='con_gru',
+                                           projected_inputs=con_i)
+            else:
+                con_inputs = tf.concat([con_i, fac_s], axis=1, )
+                # controller GRU recursion, get new state
+                # add dropout to controller inputs (MRK fix)
+                con_inputs = self.dropout(con_inputs, noise.get('con_drop'))
+                con_s_new = self.gru_block(con_inputs, con_s, cell_name='con_gru')
 
             # calculate the inputs to the generator
             with tf.name_scope("con_2_gen"):
                 # transformation to mean and logvar of the posterior
-                co_mean = linear(con_s_new, self._co_dim,
-                                 name="con_2_gen_transform_mean",)
-                co_logvar = linear(con_s_new, self._co_dim,
-                                   name="con_2_gen_transform_logvar",)
-
-                cos_posterior = DiagonalGaussianFromExisting(co_mean, co_logvar)
-                # whether to sample the posterior or pass its mean
-                # MRK, fixed the following
-                do_posterior_sample = tf.logical_or(tf.equal(self._run_type, tf.constant(kind_dict("train"))),
-                                                    tf.equal(self._run_type,
-                                                             tf.constant(kind_dict("posterior_sample_and_average"))))
-                co_out = tf.cond(do_posterior_sample, lambda: cos_posterior.sample, lambda: cos_posterior.mean)
+                co_mean = tf.matmul(con_s_new, self._con_2_gen_mean_W) + self._con_2_gen_mean_b
+                co_logvar = tf.matmul(con_s_new, self._con_2_gen_logvar_W) + self._con_2_gen_logvar_b
+
+                if self._do_posterior_sample is None:
+                    cos_posterior = DiagonalGaussianFromExisting(co_mean, co_logvar,
+                                                                 noise_bxn=noise.get('co_noise'))
+                    # whether to sample the posterior or pass its mean
+                    # MRK, fixed the following
+                    do_posterior_sample = tf.logical_or(tf.equal(self._run_type, tf.constant(kind_dict("train"))),
+                                                        tf.equal(self._run_type,
+                                                                 tf.constant(kind_dict("posterior_sample_and_average"))))
+                    co_out = tf.cond(do_posterior_sample, lambda: cos_posterior.sample, lambda: cos_posterior.mean)
+                elif self._do_posterior_sample:
+                    co_out = DiagonalGaussianFromExisting(co_mean, co_logvar,
+                                                          noise_bxn=noise.get('co_noise')).sample
+                else:
+                    # the posterior mean, no noise is drawn
+                    co_out = co_mean
         else:
             # pass zeros (0-dim) as inputs to generator
             co_out = tf.zeros([tf.shape(gen_s)[0], 0])
@@ -381,19 +577,13 @@ class ComplexCell(LayerRNNCell):
         # generator GRU recursion, get the new state
         gen_s_new = self.gru_block(gen_inputs, gen_s, cell_name='gen_gru')
         # calculate the factors
-        with tf.variable_scope("gen_2_fac", reuse=True):
-            # add dropout to gen output (MRK fix)
-            gen_s_new_dropped = tf.nn.dropout(gen_s_new, self._keep_prob)
-            # MRK, make do_bias=False, and normalized the factors
-            fac_s_new = linear(gen_s_new_dropped, self._factors_dim,
-                               name="gen_2_fac_transform",
-                               do_bias=False,
-                               normalized=True,
-                               # collections=self.col_names['fac']
-                               )
+        fac_s_new = self.gen_2_fac(gen_s_new, noise.get('gen_drop'))
         # pass the states and make other values accessible outside DynamicRNN
-        state_concat = [gen_s_new, con_s_new, co_mean, co_logvar, co_out, fac_s_new]
-        new_h = tf.concat(state_concat, axis=1)
+        if self._state_is_tuple:
+            new_h = ComplexCellStateTuple(gen_s_new, con_s_new, co_mean, co_logvar, co_out, fac_s_new)
+        else:
+            state_concat = [gen_s_new, con_s_new, co_mean, co_logvar, co_out, fac_s_new]
+            new_h = tf.concat(state_concat, axis=1)
 
         return new_h, new_h
 
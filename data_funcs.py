@@ -1,13 +1,27 @@
 import os
+import io
+import time
+import shutil
+import hashlib
 import h5py
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
 
 
 
-def load_datasets(data_dir, data_filename_stem, hps):
+# keys needed to build the model graph, but not to train or run it
+ALIGNMENT_KEYS = ('alignment_matrix_cxf', 'alignment_bias_c')
+
+# bump when the layout of the prepared dataset cache changes
+DATASET_CACHE_VERSION = 3
+
+
+def load_datasets(data_dir, data_filename_stem, hps, keys=None):
   """Load the datasets from a specified directory.
 
   Example files look like
@@ -22,60 +36,746 @@ def load_datasets(data_dir, data_filename_stem, hps):
   Args:
     data_dir: The directory from which to load the datasets.
     data_filename_stem: The stem of the filename for the datasets.
+    keys (optional): The keys to read from each file (default: all). An empty
+      collection only reads the metadata ('data_dim', 'num_steps', ...) from
+      the HDF5 headers.
+
+  If hps.data_cache_dir is set, the prepared datasets (including the
+  cross-validation masks) are cached there as memory-mapped .npy files, and
+  later calls with the same files and CV settings read the cache instead.
 
   Returns:
     datasets: a dataset dictionary, with one name->data dictionary pair for
     each dataset file.
   """
+  cache_dir = hps.get('data_cache_dir', '')
+  use_cache = bool(cache_dir) and keys is None
+  if use_cache:
+    cache_key = dataset_cache_key(data_dir, data_filename_stem, hps)
+    datasets = read_dataset_cache(cache_dir, cache_key)
+    if datasets is not None:
+      print("Read prepared datasets from cache ", os.path.join(cache_dir, cache_key))
+      return datasets
+
   print("Reading data from ", data_dir)
-  datasets = read_datasets(data_dir, data_filename_stem)
+  datasets = read_datasets(data_dir, data_filename_stem,
+                           lazy=hps.get('lazy_load_data', False), keys=keys,
+                           num_workers=hps.get('data_load_workers', 1))
   for k, data_dict in datasets.items():
+    if 'train_data' not in data_dict:
+      # metadata only, nothing to build masks for
+      datasets[k] = clean_data_dict(data_dict)
+      continue
     train_total_size = len(data_dict['train_data'])
     if train_total_size == 0:
       print("Did not load training set.")
     else:
       print("Found training set with number examples: ", train_total_size)
       if hps.cv_keep_ratio < 1.:
-        np.random.seed(int(hps.cv_rand_seed))
-        data_dict['train_data_cvmask'] = np.floor(hps.cv_keep_ratio +
-                                          np.random.random_sample(data_dict['train_data'].shape)).astype(np.float32)
-        np.random.seed()
-    valid_total_size = len(data_dict['valid_data'])
+        data_dict['train_data_cvmask'] = make_cv_mask(data_dict['train_data'].shape,
+                                                      hps.cv_keep_ratio, hps.cv_rand_seed)
+    valid_total_size = len(data_dict['valid_data']) if 'valid_data' in data_dict else 0
     if valid_total_size == 0:
       print("Did not load validation set.")
     else:
       print("Found validation set with number examples: ", valid_total_size)
       if hps.cv_keep_ratio < 1.:
-        np.random.seed(int(hps.cv_rand_seed))
-        data_dict['valid_data_cvmask'] = np.floor(hps.cv_keep_ratio +
-                                          np.random.random_sample(data_dict['valid_data'].shape)).astype(np.float32)
-        np.random.seed()
+        data_dict['valid_data_cvmask'] = make_cv_mask(data_dict['valid_data'].shape,
+                                                      hps.cv_keep_ratio, hps.cv_rand_seed)
+    if hps.get('compact_count_data', True):
+      for kind_data in ['train_data', 'valid_data']:
+        if kind_data in data_dict:
+          data_dict[kind_data] = compact_count_data(data_dict[kind_data])
+    if hps.get('sparse_data_max_density', 0) > 0:
+      for kind_data in ['train_data', 'valid_data']:
+        if kind_data in data_dict and not isinstance(data_dict[kind_data], SparseSpikeData):
+          # only data that is sparse enough is converted
+          density = SparseSpikeData.dense_density(data_dict[kind_data])
+          if density <= hps.sparse_data_max_density:
+            print("Storing %s sparse (density %.3f)" % (kind_data, density))
+            data_dict[kind_data] = SparseSpikeData.from_dense(data_dict[kind_data])
     datasets[k] = clean_data_dict(data_dict)
+
+  if use_cache:
+    write_dataset_cache(cache_dir, cache_key, datasets,
+                        max_size_gb=hps.get('data_cache_max_gb', 0))
+  return datasets
+
+
+def compact_count_data(data):
+  """Store spike counts as uint8/uint16 if every value fits exactly.
+
+  Arrays that are not in memory (memmap's, lazy handles), that are already
+  integers, or that hold negative or non-integer values are returned
+  unchanged. The model casts the data back to float32 in the graph.
+  """
+  if isinstance(data, SparseSpikeData):
+    return SparseSpikeData(data.indptr, data.indices,
+                           compact_count_data(data.values), data.shape)
+  if not isinstance(data, np.ndarray) or isinstance(data, np.memmap) \
+     or not np.issubdtype(data.dtype, np.floating) or data.size == 0:
+    return data
+  if data.min() < 0 or not np.array_equal(data, np.floor(data)):
+    return data
+  for dtype in [np.uint8, np.uint16]:
+    if data.max() <= np.iinfo(dtype).max:
+      return data.astype(dtype)
+  return data
+
+
+def cast_count_data(data, dtype):
+  """The data as dtype, for feeding the model's input data placeholder.
+
+  Data for an integer dtype (see compact_count_data) must be non-negative
+  integer counts that fit in it; anything else raises a ValueError instead
+  of being wrapped around or truncated by the feed.
+  """
+  data = np.asarray(data)
+  dtype = np.dtype(dtype)
+  if data.dtype == dtype or not np.issubdtype(dtype, np.integer) or data.size == 0:
+    return data
+  info = np.iinfo(dtype)
+  fits = data.min() >= info.min and data.max() <= info.max
+  if not fits or (not np.issubdtype(data.dtype, np.integer) and
+                  not np.array_equal(data, np.floor(data))):
+    raise ValueError("The model takes %s spike counts (see hps.compact_count_data), "
+                     "got %s data with values that are not integers in [%d, %d]"
+                     % (dtype.name, data.dtype.name, info.min, info.max))
+  return data.astype(dtype)
+
+
+def input_data_dtype(datasets):
+  """The dtype the model should feed the data with: the common integer type
+  of all 'train_data'/'valid_data' arrays, or float32 if any are not integer.
+  """
+  dtypes = [data_dict[k].dtype for data_dict in (datasets or {}).values()
+            for k in ['train_data', 'valid_data']
+            if data_dict.get(k) is not None]
+  if dtypes and all(np.issubdtype(dtype, np.unsignedinteger) for dtype in dtypes):
+    return np.result_type(*dtypes)
+  return np.dtype(np.float32)
+
+
+def dataset_cache_key(data_dir, data_filename_stem, hps):
+  """Key of the prepared dataset cache entry for these files and CV settings.
+
+  The files are fingerprinted by name, size and modification time, which is
+  enough to notice a rewritten file without hashing gigabytes of data.
+  """
+  fingerprint = [DATASET_CACHE_VERSION, os.path.abspath(data_dir),
+                 data_filename_stem, float(hps.cv_keep_ratio),
+                 float(hps.cv_rand_seed), bool(hps.get('compact_count_data', True)),
+                 float(hps.get('sparse_data_max_density', 0))]
+  for fname in sorted(os.listdir(data_dir)):
+    if fname.startswith(data_filename_stem):
+      st = os.stat(os.path.join(data_dir, fname))
+      fingerprint.append([fname, st.st_size, st.st_mtime_ns])
+  return hashlib.sha1(json.dumps(fingerprint).encode('utf-8')).hexdigest()
+
+
+def read_dataset_cache(cache_dir, cache_key):
+  """Open a prepared dataset cache entry, or return None if there is none.
+
+  Arrays come back as read-only np.memmap's, the other values from the
+  entry's index file.
+  """
+  entry_dir = os.path.join(cache_dir, cache_key)
+  index_fname = os.path.join(entry_dir, 'index.json')
+  if not os.path.exists(index_fname):
+    return None
+  with open(index_fname, 'r') as f:
+    index = json.load(f)
+  datasets = {}
+  for name, entries in index['datasets']:
+    data_dict = {}
+    for k, (kind, value) in entries:
+      if kind == 'npy':
+        npy_fname = os.path.join(entry_dir, value)
+        try:
+          data_dict[k] = np.load(npy_fname, mmap_mode='r')
+        except ValueError:
+          # arrays of Python objects (e.g. variable-length strings) can't be memory-mapped
+          data_dict[k] = np.load(npy_fname, allow_pickle=True)
+        if data_dict[k].ndim == 0:
+          data_dict[k] = np.array(data_dict[k])
+      elif kind == 'packed_mask':
+        bits = np.load(os.path.join(entry_dir, value[0]), mmap_mode='r')
+        data_dict[k] = PackedMask(bits, tuple(value[1]))
+      elif kind == 'sparse':
+        indptr, indices, values = [np.load(os.path.join(entry_dir, fname), mmap_mode='r')
+                                   for fname in value[0]]
+        data_dict[k] = SparseSpikeData(indptr, indices, values, tuple(value[1]))
+      else:
+        data_dict[k] = value
+    datasets[name] = data_dict
+  # mark as recently used for the LRU size cap
+  os.utime(index_fname, None)
   return datasets
 
 
-def read_data(data_fname):
+def write_dataset_cache(cache_dir, cache_key, datasets, max_size_gb=0):
+  """Write prepared datasets to a cache entry as .npy files.
+
+  Every array keeps its dtype (scalars are stored as 0-d arrays); the other
+  values go into the entry's index file. Lazily loaded arrays are copied a
+  block of trials at a time (see _save_npy).
+
+  The entry is written to a temporary directory and renamed into place, so
+  concurrent jobs never see a partial entry. If max_size_gb > 0, the least
+  recently used entries are then removed until the cache fits.
+  """
+  entry_dir = os.path.join(cache_dir, cache_key)
+  if os.path.exists(entry_dir):
+    return
+  tmp_dir = entry_dir + '.tmp%d' % os.getpid()
+  try:
+    os.makedirs(tmp_dir)
+    index = []
+    for d, (name, data_dict) in enumerate(datasets.items()):
+      entries = []
+      for k, v in data_dict.items():
+        if isinstance(v, PackedMask):
+          npy_fname = '%d_%s.npy' % (d, k)
+          np.save(os.path.join(tmp_dir, npy_fname), np.ascontiguousarray(v.bits))
+          entries.append([k, ['packed_mask', [npy_fname, list(v.shape)]]])
+        elif isinstance(v, SparseSpikeData):
+          npy_fnames = []
+          for part in ['indptr', 'indices', 'values']:
+            npy_fnames.append('%d_%s_%s.npy' % (d, k, part))
+            np.save(os.path.join(tmp_dir, npy_fnames[-1]), np.ascontiguousarray(getattr(v, part)))
+          entries.append([k, ['sparse', [npy_fnames, list(v.shape)]]])
+        elif hasattr(v, 'shape') and hasattr(v, 'dtype'):
+          # arrays (0-d ones included) keep their dtype, so a cache hit
+          # returns the same values as a miss
+          npy_fname = '%d_%s.npy' % (d, k)
+          _save_npy(os.path.join(tmp_dir, npy_fname), v)
+          entries.append([k, ['npy', npy_fname]])
+        else:
+          entries.append([k, ['value', v]])
+      index.append([name, entries])
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+      json.dump({'version': DATASET_CACHE_VERSION, 'datasets': index}, f)
+    os.rename(tmp_dir, entry_dir)
+  except Exception as e:
+    # another job may have written the same entry, the disk is full, or a
+    # value can't be stored; carry on without the cache
+    print("Could not write dataset cache entry %s: %s" % (entry_dir, e))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return
+  if max_size_gb > 0:
+    prune_dataset_cache(cache_dir, max_size_gb, keep=cache_key)
+
+
+def _save_npy(fname, v, chunk_elements=2**22):
+  """np.save an array. LazyH5Dataset handles are copied into the .npy file a
+  few trials at a time (like SparseSpikeData.from_dense), so lazily loaded
+  data never has to fit in memory."""
+  if not isinstance(v, LazyH5Dataset) or v.dtype.hasobject:
+    v = np.asarray(v) if len(v.shape) == 0 else np.ascontiguousarray(v)
+    np.save(fname, v, allow_pickle=v.dtype.hasobject)
+    return
+  out = np.lib.format.open_memmap(fname, mode='w+', dtype=v.dtype, shape=v.shape)
+  step = max(1, chunk_elements // max(1, int(np.prod(v.shape[1:]))))
+  for start in range(0, v.shape[0], step):
+    out[start:start + step] = v[start:start + step]
+  out.flush()
+  del out
+
+
+def prune_dataset_cache(cache_dir, max_size_gb, keep=None):
+  """Remove least recently used cache entries until the cache fits."""
+  entries = []
+  for key in os.listdir(cache_dir):
+    index_fname = os.path.join(cache_dir, key, 'index.json')
+    if key == keep or not os.path.exists(index_fname):
+      continue
+    entry_dir = os.path.join(cache_dir, key)
+    size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+    entries.append((os.path.getmtime(index_fname), size, entry_dir))
+  total_size = sum(e[1] for e in entries)
+  if keep is not None and os.path.isdir(os.path.join(cache_dir, keep)):
+    keep_dir = os.path.join(cache_dir, keep)
+    total_size += sum(os.path.getsize(os.path.join(keep_dir, f)) for f in os.listdir(keep_dir))
+  for _, size, entry_dir in sorted(entries):
+    if total_size <= max_size_gb * 1024**3:
+      break
+    print("Removing least recently used dataset cache entry ", entry_dir)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    total_size -= size
+
+
+class PackedMask(object):
+  """Binary (0/1) mask over trials, stored with one bit per element.
+
+  Indexing along the trial axis unpacks just those trials and returns them
+  as float32, so a batch of the mask costs the same as before while the
+  full mask takes 1/32 of the memory of a float32 array.
+  """
+
+  def __init__(self, bits, shape):
+    # bits: ntrials x ceil(prod(shape[1:]) / 8) uint8
+    self.bits = bits
+    self.shape = tuple(shape)
+    self.dtype = np.dtype(np.float32)
+    self.ndim = len(self.shape)
+    self._trial_size = int(np.prod(self.shape[1:]))
+
+  def __len__(self):
+    return self.shape[0]
+
+  def _unpack(self, bits):
+    mask = np.unpackbits(bits, axis=-1, count=self._trial_size)
+    return mask.reshape(bits.shape[:-1] + self.shape[1:]).astype(np.float32)
+
+  def __getitem__(self, idx):
+    rest = ()
+    if isinstance(idx, tuple):
+      idx, rest = idx[0], idx[1:]
+    mask = self._unpack(self.bits[idx])
+    if rest:
+      lead = mask.ndim - (self.ndim - 1)
+      mask = mask[(slice(None),) * lead + rest]
+    return mask
+
+  def __array__(self, dtype=None, copy=None):
+    mask = self._unpack(self.bits)
+    return mask if dtype is None else mask.astype(dtype)
+
+  def astype(self, dtype):
+    return np.asarray(self).astype(dtype)
+
+
+def make_cv_mask(shape, cv_keep_ratio, cv_rand_seed, chunk_elements=2**22):
+  """Draw the held-out cross-validation mask for an array of this shape.
+
+  The mask is the same as np.floor(cv_keep_ratio + random_sample(shape))
+  after seeding with cv_rand_seed, but it is drawn a few trials at a time
+  and packed to bits as it goes, so the float64 draw never exists in full.
+
+  Returns:
+    A PackedMask (1 = held-in, 0 = held-out).
+  """
+  rng = np.random.RandomState(int(cv_rand_seed))
+  ntrials = shape[0]
+  trial_size = int(np.prod(shape[1:]))
+  bits = np.zeros((ntrials, (trial_size + 7) // 8), dtype=np.uint8)
+  step = max(1, chunk_elements // max(1, trial_size))
+  for start in range(0, ntrials, step):
+    stop = min(start + step, ntrials)
+    # drawing the stream in consecutive chunks gives the same numbers
+    # as drawing it all at once
+    mask = np.floor(cv_keep_ratio +
+                    rng.random_sample((stop - start,) + tuple(shape[1:])))
+    bits[start:stop] = np.packbits(mask.reshape(stop - start, trial_size).astype(np.uint8),
+                                   axis=1)
+  return PackedMask(bits, shape)
+
+
+class SparseSpikeData(object):
+  """Trials x time x neurons data stored sparse, for mostly-zero spike counts.
+
+  Each trial is one row of a CSR matrix over its flattened (time, neuron)
+  bins: the nonzero bins of trial i are indices[indptr[i]:indptr[i+1]]
+  (flat positions t * ndims + n) with counts values[indptr[i]:indptr[i+1]].
+
+  Indexing along the trial axis returns those trials dense, like an array,
+  so code that slices the data keeps working. For training, coo_batch
+  returns the batch as a tf.SparseTensorValue, which the model densifies
+  on the device.
+
+  In an HDF5 file the same layout is a group (e.g. 'train_data') holding the
+  datasets 'indptr', 'indices' and 'values' and a 'shape' attribute, see
+  write_h5.
+  """
+
+  def __init__(self, indptr, indices, values, shape):
+    self.indptr = indptr
+    self.indices = indices
+    self.values = values
+    self.shape = tuple(int(n) for n in shape)
+    self.dtype = values.dtype
+    self.ndim = len(self.shape)
+    self._trial_size = int(np.prod(self.shape[1:]))
+
+  @classmethod
+  def from_dense(cls, data, chunk_elements=2**24):
+    """Convert a dense (or array-like) trials x time x neurons array.
+
+    The data is read a few trials at a time, so data that is memory-mapped
+    or lazily read never needs to fit in memory dense.
+    """
+    ntrials = data.shape[0]
+    trial_size = int(np.prod(data.shape[1:]))
+    index_dtype = np.int32 if trial_size < 2**31 else np.int64
+    step = max(1, chunk_elements // max(1, trial_size))
+    indptr = np.zeros(ntrials + 1, dtype=np.int64)
+    indices, values = [], []
+    for start in range(0, ntrials, step):
+      stop = min(start + step, ntrials)
+      chunk = np.asarray(data[start:stop]).reshape(stop - start, trial_size)
+      rows, cols = np.nonzero(chunk)
+      indptr[start + 1:stop + 1] = indptr[start] + np.cumsum(
+        np.bincount(rows, minlength=stop - start))
+      indices.append(cols.astype(index_dtype))
+      values.append(chunk[rows, cols])
+    dtype = np.dtype(data.dtype)
+    indices = np.concatenate(indices) if indices else np.zeros(0, index_dtype)
+    values = np.concatenate(values) if values else np.zeros(0, dtype)
+    return cls(indptr, indices, values, data.shape)
+
+  @staticmethod
+  def dense_density(data, chunk_elements=2**24):
+    """Fraction of nonzero entries of a dense (or array-like) array, counted a
+    few trials at a time like from_dense, without building the sparse data."""
+    ntrials = data.shape[0]
+    step = max(1, chunk_elements // max(1, int(np.prod(data.shape[1:]))))
+    nnz = sum(np.count_nonzero(np.asarray(data[start:start + step]))
+              for start in range(0, ntrials, step))
+    return nnz / float(max(1, np.prod(data.shape)))
+
+  @classmethod
+  def read_h5(cls, group):
+    return cls(group['indptr'][()], group['indices'][()], group['values'][()],
+               group.attrs['shape'])
+
+  def write_h5(self, hf, key, compression=None):
+    """Write this data as a sparse group 'key' in the open HDF5 file hf."""
+    group = hf.create_group(key)
+    group.attrs['shape'] = self.shape
+    for part in ['indptr', 'indices', 'values']:
+      group.create_dataset(part, data=getattr(self, part), compression=compression)
+
+  @property
+  def nnz(self):
+    return len(self.values)
+
+  @property
+  def density(self):
+    return self.nnz / float(max(1, np.prod(self.shape)))
+
+  @property
+  def nbytes(self):
+    return self.indptr.nbytes + self.indices.nbytes + self.values.nbytes
+
+  def __len__(self):
+    return self.shape[0]
+
+  def _gather(self, trials):
+    """Batch row, flat position and value of every nonzero bin of these trials."""
+    starts = self.indptr[trials]
+    lengths = self.indptr[trials + 1] - starts
+    rows = np.repeat(np.arange(len(trials)), lengths)
+    # position of every nonzero entry in the indices/values arrays
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pos = np.repeat(starts, lengths) + offsets
+    return rows, np.asarray(self.indices[pos]), np.asarray(self.values[pos])
+
+  def _trial_indices(self, idx):
+    return np.arange(self.shape[0])[idx]
+
+  def coo_batch(self, idx):
+    """The trials idx as a tf.SparseTensorValue (indices in row-major order)."""
+    trials = np.atleast_1d(self._trial_indices(idx))
+    rows, flat, values = self._gather(trials)
+    ndims = self.shape[2]
+    indices = np.stack([rows, flat // ndims, flat % ndims], axis=1).astype(np.int64)
+    return tf.compat.v1.SparseTensorValue(indices, values,
+                                          (len(trials),) + self.shape[1:])
+
+  def __getitem__(self, idx):
+    rest = ()
+    if isinstance(idx, tuple):
+      idx, rest = idx[0], idx[1:]
+    trials = self._trial_indices(idx)
+    squeeze = np.ndim(trials) == 0
+    trials = np.atleast_1d(trials)
+    rows, flat, values = self._gather(trials)
+    data = np.zeros((len(trials), self._trial_size), dtype=self.dtype)
+    data[rows, flat] = values
+    data = data.reshape((len(trials),) + self.shape[1:])
+    if squeeze:
+      data = data[0]
+    if rest:
+      lead = data.ndim - (self.ndim - 1)
+      data = data[(slice(None),) * lead + rest]
+    return data
+
+  def __array__(self, dtype=None, copy=None):
+    data = self[:]
+    return data if dtype is None else data.astype(dtype)
+
+  def astype(self, dtype):
+    return np.asarray(self).astype(dtype)
+
+
+class LazyH5Dataset(object):
+  """Array-like handle on a chunked or compressed HDF5 dataset.
+
+  Only the rows that are indexed are read from disk, so indexing a batch of
+  trials out of 'train_data' touches just those trials. h5py requires sorted,
+  unique indices for fancy indexing, so indices are sorted for the read and
+  the original order (including repeats) is restored afterwards.
+  """
+
+  def __init__(self, hf, key):
+    self._hf = hf
+    self._key = key
+    self._dset = hf[key]
+    self.shape = self._dset.shape
+    self.chunks = self._dset.chunks
+    self.dtype = self._dset.dtype
+    self.ndim = len(self.shape)
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, idx):
+    rest = ()
+    if isinstance(idx, tuple):
+      idx, rest = idx[0], idx[1:]
+    if isinstance(idx, (list, np.ndarray)):
+      idx = np.asarray(idx)
+      if idx.dtype == np.bool_:
+        idx = np.flatnonzero(idx)
+      uniq, inverse = np.unique(idx, return_inverse=True)
+      rows = self._dset[uniq]
+      return rows[(inverse,) + rest]
+    return self._dset[(idx,) + rest]
+
+  def __array__(self, dtype=None, copy=None):
+    arr = self._dset[()]
+    return arr if dtype is None else arr.astype(dtype)
+
+  def astype(self, dtype):
+    return np.asarray(self).astype(dtype)
+
+
+def is_out_of_core(data):
+  """True if indexing this data reads it from disk."""
+  return isinstance(data, (LazyH5Dataset, np.memmap))
+
+
+def shuffle_block_size(data, default):
+  """Trials per shuffle block for out-of-core data: its HDF5 chunk length
+  along the trial axis, if it has one."""
+  chunks = getattr(data, 'chunks', None)
+  return chunks[0] if chunks else default
+
+
+def _put_unless_stopped(q, stop, item):
+  """Put item on the queue, giving up (returning False) once stop is set."""
+  while not stop.is_set():
+    try:
+      q.put(item, timeout=0.1)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+def prefetch(iterable, depth):
+  """Iterate over iterable in a background thread, up to depth items ahead.
+
+  The items come out in the same order, and an exception raised by the
+  iterable is re-raised here. With depth <= 0 nothing runs in the background.
+  """
+  if depth <= 0:
+    for item in iterable:
+      yield item
+    return
+  q = queue.Queue(maxsize=depth)
+  stop = threading.Event()
+  done = object()
+
+  def fill():
+    try:
+      for item in iterable:
+        if not _put_unless_stopped(q, stop, (True, item)):
+          return
+      _put_unless_stopped(q, stop, (True, done))
+    except Exception as e:
+      _put_unless_stopped(q, stop, (False, e))
+
+  thread = threading.Thread(target=fill)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      ok, item = q.get()
+      if not ok:
+        raise item
+      if item is done:
+        return
+      yield item
+  finally:
+    stop.set()
+    thread.join()
+
+
+class ReadAheadBatches(object):
+  """Iterate over batches of trials of out-of-core arrays, reading ahead.
+
+  The batches (trial index arrays, in the order they will be used) are
+  grouped into windows of consecutive batches with at most buffer_size
+  distinct trials. A background thread reads each window with one sorted
+  read per array while the previous window is being trained on, so about
+  three windows are in memory at a time.
+
+  Iterating yields, for every batch, a tuple with the batch of each array
+  (None for arrays that are None).
+  """
+
+  def __init__(self, arrays, batches, buffer_size):
+    self._arrays = arrays
+    self._windows = []
+    window, window_trials = [], set()
+    for batch in batches:
+      if window and len(window_trials.union(batch)) > buffer_size:
+        self._windows.append(window)
+        window, window_trials = [], set()
+      window.append(np.asarray(batch))
+      window_trials.update(batch)
+    if window:
+      self._windows.append(window)
+    self._queue = queue.Queue(maxsize=1)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._read_windows)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _read_windows(self):
+    try:
+      for window in self._windows:
+        trials = np.unique(np.concatenate(window))
+        rows = [None if a is None else np.asarray(a[trials]) for a in self._arrays]
+        if not _put_unless_stopped(self._queue, self._stop, (window, trials, rows)):
+          return
+    except Exception as e:
+      _put_unless_stopped(self._queue, self._stop, e)
+
+  def __iter__(self):
+    try:
+      for _ in range(len(self._windows)):
+        item = self._queue.get()
+        if isinstance(item, Exception):
+          raise item
+        window, trials, rows = item
+        for batch in window:
+          pos = np.searchsorted(trials, batch)
+          yield tuple(None if r is None else r[pos] for r in rows)
+    finally:
+      self.close()
+
+  def close(self):
+    """Stop the read-ahead thread (iterating to the end also does this)."""
+    self._stop.set()
+    self._thread.join()
+
+
+def _lazy_h5_value(data_fname, hf, key):
+  """Return a lazy handle on a dataset, falling back to a full read."""
+  dset = hf[key]
+  if isinstance(dset, h5py.Group):
+    # sparse data is small enough to keep in memory
+    return SparseSpikeData.read_h5(dset)
+  if dset.shape == () or dset.size == 0:
+    # scalars and empty arrays are cheap to read outright
+    return np.array(dset)
+  offset = dset.id.get_offset()
+  if dset.chunks is None and offset is not None:
+    # contiguous, uncompressed storage: the OS pages data in on demand
+    return np.memmap(data_fname, dtype=dset.dtype, mode='r',
+                     offset=offset, shape=dset.shape)
+  return LazyH5Dataset(hf, key)
+
+
+def _h5_shapes(hf):
+  """Shapes of all arrays (and sparse groups) in an open HDF5 file."""
+  return {k: tuple(v.attrs['shape']) if isinstance(v, h5py.Group) else v.shape
+          for k, v in hf.items()}
+
+
+def read_data_shapes(data_fname):
+  """ Read the shapes of all arrays in an HDF5 file without reading the data.
+
+  Args:
+    data_fname: The filename of the file from which to read the shapes.
+  Returns:
+    A dictionary mapping each key in the file to its shape.
+  """
+
+  try:
+    with h5py.File(data_fname, 'r') as hf:
+      return _h5_shapes(hf)
+  except IOError:
+    print("Cannot open %s for reading." % data_fname)
+    raise
+
+
+def read_data(data_fname, lazy=False, chunk_cache_mb=64, keys=None, return_shapes=False):
   """ Read saved data in HDF5 format.
 
   Args:
     data_fname: The filename of the file from which to read the data.
+    lazy (optional): If True, do not read the arrays into memory. Contiguous
+      datasets are returned as read-only np.memmap's and chunked/compressed
+      datasets as LazyH5Dataset handles, so only the indexed trials are read.
+    chunk_cache_mb (optional): Size of the HDF5 chunk cache (per file) used
+      by the LazyH5Dataset handles.
+    keys (optional): Only read these keys (those missing from the file are
+      skipped). Default is to read every key.
+    return_shapes (optional): Also return the shapes of all arrays in the
+      file (as read_data_shapes does), read while the file is open.
+  Groups written by SparseSpikeData.write_h5 are read as SparseSpikeData.
   Returns:
     A dictionary whose keys will vary depending on dataset (but should
     always contain the keys 'train_data' and 'valid_data') and whose
-    values are numpy arrays.
+    values are numpy arrays (or array-like handles if lazy is True).
+    With return_shapes, a (data_dict, shapes) tuple.
   """
 
   try:
+    if lazy:
+      # the file must stay open for as long as the LazyH5Dataset handles live
+      hf = h5py.File(data_fname, 'r', rdcc_nbytes=int(chunk_cache_mb * 1024**2))
+      data_dict = {k: _lazy_h5_value(data_fname, hf, k) for k in hf.keys()
+                   if keys is None or k in keys}
+      shapes = _h5_shapes(hf) if return_shapes else None
+      if not any(isinstance(v, LazyH5Dataset) for v in data_dict.values()):
+        hf.close()
+      return (data_dict, shapes) if return_shapes else data_dict
     with h5py.File(data_fname, 'r') as hf:
-      data_dict = {k: np.array(v) for k, v in hf.items()}
-      return data_dict
+      data_dict = {k: SparseSpikeData.read_h5(v) if isinstance(v, h5py.Group) else np.array(v)
+                   for k, v in hf.items() if keys is None or k in keys}
+      return (data_dict, _h5_shapes(hf)) if return_shapes else data_dict
   except IOError:
     print("Cannot open %s for reading." % data_fname)
     raise
 
 
 
-def read_datasets(data_path, data_fname_stem):
+def _read_dataset_file(data_fname, lazy=False, keys=None, read_into_memory=False):
+  """Read one dataset file for read_datasets and time it.
+
+  With read_into_memory the raw file is read in a single call before HDF5
+  parses it. Plain file reads release the GIL (h5py calls do not), so this
+  is what lets several worker threads hit the disk at the same time.
+  """
+  start_time = time.time()
+  if read_into_memory:
+    with open(data_fname, 'rb') as f:
+      h5_source = io.BytesIO(f.read())
+  else:
+    h5_source = data_fname
+  # the shapes come from the same open file, a second open costs a round trip
+  #  on network disks
+  data_dict, shapes = read_data(h5_source, lazy=lazy, keys=keys, return_shapes=True)
+  nbytes = sum(v.nbytes for v in data_dict.values()
+               if isinstance(v, (np.ndarray, SparseSpikeData)) and not isinstance(v, np.memmap))
+  return data_dict, shapes, nbytes, time.time() - start_time
+
+
+def read_datasets(data_path, data_fname_stem, lazy=False, keys=None, num_workers=1):
   """Read datasets in HDF5 format.
 
   This function assumes the dataset_dict is a mapping ( string ->
@@ -85,19 +785,33 @@ def read_datasets(data_path, data_fname_stem):
   Args:
     data_path: The path to the save directory.
     data_fname_stem: The filename stem of the file in which to write the data.
+    lazy (optional): If True, return lazy array handles (see read_data).
+    keys (optional): Only read these keys from each file (see read_data).
+      'data_dim' and 'num_steps' are always filled in from the HDF5 headers.
+    num_workers (optional): Number of files to read concurrently. The order
+      of the returned dictionary does not depend on it.
   """
 
   dataset_dict = {}
-  fnames = os.listdir(data_path)
+  fnames = [fname for fname in os.listdir(data_path)
+            if fname.startswith(data_fname_stem)]
 
   print ('loading data from ' + data_path + ' with stem ' + data_fname_stem)
-  for fname in fnames:
-    if fname.startswith(data_fname_stem):
-      data_dict = read_data(os.path.join(data_path,fname))
+  # lazy and key-subset reads only touch the headers, no need to pull whole files
+  read_into_memory = num_workers > 1 and not lazy and keys is None
+  start_time = time.time()
+  with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+    futures = [executor.submit(_read_dataset_file, os.path.join(data_path, fname),
+                               lazy, keys, read_into_memory)
+               for fname in fnames]
+    # collect in submission order so the dict order matches os.listdir
+    for fname, future in zip(fnames, futures):
+      data_dict, shapes, nbytes, read_time = future.result()
+      print('  read %s: %.1f MB in %.2f s' % (fname, nbytes / 1024.**2, read_time))
       idx = len(data_fname_stem) + 1
       key = fname[idx:]
-      data_dict['data_dim'] = data_dict['train_data'].shape[2]
-      data_dict['num_steps'] = data_dict['train_data'].shape[1]
+      data_dict['data_dim'] = shapes['train_data'][2]
+      data_dict['num_steps'] = shapes['train_data'][1]
       dataset_dict[key] = data_dict
 
   if len(dataset_dict) == 0:
@@ -105,7 +819,7 @@ def read_datasets(data_path, data_fname_stem):
                      "'--data_dir' and '--data_filename_stem' flag values "
                      "are correct?")
 
-  print (str(len(dataset_dict)) + ' datasets loaded')
+  print (str(len(dataset_dict)) + ' datasets loaded in %.2f s' % (time.time() - start_time))
   return dataset_dict
 
 
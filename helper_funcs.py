@@ -36,6 +36,27 @@ def kind_dict_key(kind_number):
             return key
 
 
+def graph_run_type(hps):
+    # the run type a graph built for hps.kind is specialized to (see LFADS),
+    #  None for a graph that runs more than one
+    if not hps.get('specialize_run_type', False):
+        return None
+    kind = kind_dict_key(hps.kind)
+    if kind == 'write_model_params':
+        # nothing is run, the means need the least work
+        return 'posterior_mean'
+    if kind in ['posterior_sample_and_average', 'posterior_mean']:
+        return kind
+    # training graphs also run the posterior means (the R^2,
+    #  return_model_output), so they keep the choice
+    return None
+
+
+def run_type_samples_posterior(run_type):
+    # whether runs of this type (a kind number) sample the posteriors, or pass their means
+    return run_type in [kind_dict('train'), kind_dict('posterior_sample_and_average')]
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -116,12 +137,12 @@ def linear(x, out_size, name, collections=None, mat_init_value=None, bias_init_v
     return tf.matmul(x, W) + b
 
 
-def ListOfRandomBatches(num_trials, batch_size):
+def ListOfRandomBatches(num_trials, batch_size, rng=np.random):
     if num_trials <= batch_size:
         warnings.warn("Your batch size is bigger than num_trials! Using single batch ...")
-        return [np.random.permutation(range(num_trials))]
+        return [rng.permutation(range(num_trials))]
 
-    random_order = np.random.permutation(range(num_trials))
+    random_order = rng.permutation(range(num_trials))
     even_num_of_batches = int(np.floor(num_trials / batch_size))
     trials_to_keep = even_num_of_batches * batch_size
     # if num_trials % batch_size != 0:
@@ -131,6 +152,134 @@ def ListOfRandomBatches(num_trials, batch_size):
     return batches
 
 
+def ListOfBlockShuffledBatches(num_trials, batch_size, block_size, buffer_size, rng=np.random):
+    """Random batches that only touch a few contiguous blocks of trials at once.
+
+    For data read from disk (e.g. chunked HDF5): the blocks of block_size
+    trials are visited in random order, and their trials go through a shuffle
+    buffer of about buffer_size trials, which is shuffled and cut into
+    batches. Trials that do not fill a batch carry over to the next buffer;
+    as in ListOfRandomBatches, those left at the end are dropped.
+    """
+    if num_trials <= batch_size:
+        warnings.warn("Your batch size is bigger than num_trials! Using single batch ...")
+        return [rng.permutation(range(num_trials))]
+
+    block_size = max(1, block_size)
+    buffer_size = max(buffer_size, batch_size)
+    block_starts = rng.permutation(range(0, num_trials, block_size))
+    batches = []
+    shuffle_buffer = np.zeros(0, dtype=np.int64)
+    for i, start in enumerate(block_starts):
+        block = np.arange(start, min(start + block_size, num_trials))
+        shuffle_buffer = np.concatenate([shuffle_buffer, block])
+        if len(shuffle_buffer) >= buffer_size or i == len(block_starts) - 1:
+            shuffle_buffer = rng.permutation(shuffle_buffer)
+            num_batches = len(shuffle_buffer) // batch_size
+            batches += [shuffle_buffer[j * batch_size:(j + 1) * batch_size]
+                        for j in range(num_batches)]
+            shuffle_buffer = shuffle_buffer[num_batches * batch_size:]
+    return batches
+
+
+class EpochPlanner(object):
+    """Plans which dataset and trials each step of an epoch uses.
+
+    Since datasets may differ in dimensionality, every batch comes from one
+    dataset. Each dataset's batches are random (ListOfRandomBatches, or
+    ListOfBlockShuffledBatches for datasets given a block size) when
+    training, or consecutive trials for validation. The datasets are then
+    interleaved at random, keeping each dataset's batch order.
+
+    With mix_datasets, the trials of all datasets are pooled instead, and
+    batches mix trials of several datasets (see hps.mix_session_batches).
+
+    The number of steps per epoch follows from the trial counts alone, and
+    plans are generated lazily. Plan number i is drawn from a RandomState
+    seeded with (seed, shuffle, i), so any epoch can be generated again, from
+    any step.
+
+    Args:
+      num_trials: List of (dataset name, number of trials) pairs.
+      batch_size: Trials per batch.
+      shuffle (optional): Random batches (training) or consecutive ones
+        (validation, the last batch may be smaller).
+      seed (optional): Seed of the plans.
+      block_sizes (optional): Dict of dataset name -> shuffle block size, for
+        the datasets to block-shuffle with a buffer of buffer_size trials.
+      buffer_size (optional): See block_sizes.
+      mix_datasets (optional): Batches of the pooled trials. Their steps are
+        (array of dataset names, array of trial indices) pairs, one entry per
+        trial. block_sizes do not apply.
+    """
+
+    def __init__(self, num_trials, batch_size, shuffle=True, seed=0,
+                 block_sizes=None, buffer_size=0, mix_datasets=False):
+        self.num_trials = list(num_trials)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.block_sizes = {} if mix_datasets else block_sizes or {}
+        self.buffer_size = buffer_size
+        self.mix_datasets = mix_datasets
+        # number of the plan the next call to plan() returns
+        self.epoch = 0
+
+    def num_batches(self, num_trials):
+        if not self.shuffle:
+            return -(-num_trials // self.batch_size)
+        # ListOfRandomBatches makes one batch of all trials if there are too few
+        return 1 if num_trials <= self.batch_size else num_trials // self.batch_size
+
+    @property
+    def num_steps(self):
+        """Steps per epoch."""
+        if self.mix_datasets:
+            return self.num_batches(sum(n for _, n in self.num_trials))
+        return sum(self.num_batches(n) for _, n in self.num_trials)
+
+    def _batches(self, name, num_trials, rng):
+        if not self.shuffle:
+            return [list(range(i, min(i + self.batch_size, num_trials)))
+                    for i in range(0, num_trials, self.batch_size)]
+        if name in self.block_sizes:
+            return ListOfBlockShuffledBatches(num_trials, self.batch_size, self.block_sizes[name],
+                                              self.buffer_size, rng=rng)
+        return ListOfRandomBatches(num_trials, self.batch_size, rng=rng)
+
+    def plan(self, epoch=None, start_step=0):
+        """Generate the (dataset name, trial indices) pairs of an epoch.
+
+        Args:
+          epoch (optional): Number of the plan. By default the next one, and
+            the plan after that is returned next time.
+          start_step (optional): Skip the steps before this one.
+        """
+        if epoch is None:
+            epoch = self.epoch
+            self.epoch += 1
+        rng = np.random.RandomState([self.seed, int(self.shuffle), epoch])
+        if self.mix_datasets:
+            trial_names = np.concatenate([[name] * n for name, n in self.num_trials])
+            trial_idxs = np.concatenate([np.arange(n) for _, n in self.num_trials])
+            for step, idxs in enumerate(self._batches(None, len(trial_names), rng)):
+                if step >= start_step:
+                    yield trial_names[idxs], trial_idxs[idxs]
+            return
+        names = []
+        for name, n in self.num_trials:
+            names += [name] * self.num_batches(n)
+        rng.shuffle(names)
+        # a dataset's batches are drawn when its first batch is needed
+        batches = {}
+        for step, name in enumerate(names):
+            if name not in batches:
+                batches[name] = iter(self._batches(name, dict(self.num_trials)[name], rng))
+            idxs = next(batches[name])
+            if step >= start_step:
+                yield name, idxs
+
+
 class Gaussian(object):
     """Base class for Gaussian distribution classes."""
     @property
@@ -200,14 +349,17 @@ class DiagonalGaussianFromExisting(Gaussian):
     dimension.
     """
 
-    def __init__(self, mean_bxn, logvar_bxn, var_min=0.0):
+    def __init__(self, mean_bxn, logvar_bxn, var_min=0.0, noise_bxn=None):
         self.mean_bxn = mean_bxn
         if var_min > 0.0:
             logvar_bxn = tf.log(tf.exp(logvar_bxn) + var_min)
             #logvar_bxn = tf.nn.relu(logvar_bxn) + tf.log(var_min)
         self.logvar_bxn = logvar_bxn
 
-        self.noise_bxn = noise_bxn = tf.random_normal(tf.shape(logvar_bxn))
+        # the standard normal noise of the sample may be drawn beforehand
+        if noise_bxn is None:
+            noise_bxn = tf.random_normal(tf.shape(logvar_bxn))
+        self.noise_bxn = noise_bxn
         #self.noise_bxn.set_shape([None, z_size])
         self.sample_bxn = mean_bxn + tf.exp(0.5 * logvar_bxn) * noise_bxn
 
@@ -342,16 +494,16 @@ class LearnableAutoRegressive1Prior(object):
     # with these parameters.
     log_evar_inits_1xu = tf.expand_dims(tf.log(noise_variances), 0)
     self.logevars_1xu = logevars_1xu = \
-        tf.Variable(log_evar_inits_1xu, name=name+"/logevars", dtype=tf.float32,
-                    trainable=do_train_prior_ar_nvar)
+        tf.get_variable(name+"/logevars", initializer=log_evar_inits_1xu, dtype=tf.float32,
+                        trainable=do_train_prior_ar_nvar)
     self.logevars_bxu = logevars_bxu = tf.tile(logevars_1xu, size_bx1)
     logevars_bxu.set_shape(size__xu) # tile loses shape
 
     # \tau, which is the autocorrelation time constant of the AR(1) process
     log_atau_inits_1xu = tf.expand_dims(tf.log(autocorrelation_taus), 0)
     self.logataus_1xu = logataus_1xu = \
-        tf.Variable(log_atau_inits_1xu, name=name+"/logatau", dtype=tf.float32,
-                    trainable=do_train_prior_ar_atau)
+        tf.get_variable(name+"/logatau", initializer=log_atau_inits_1xu, dtype=tf.float32,
+                        trainable=do_train_prior_ar_atau)
 
     # phi in x_t = \mu + phi x_tm1 + \eps
     # phi = exp(-1/tau)
@@ -448,9 +600,13 @@ class LinearTimeVarying(object):
         #tiled_b = tf.reshape(tiled_b, [-1, b.get_shape()[0], b.get_shape()[1]])
         #output = tf.matmul(inputs, tiled_W) + tiled_b
 
-        tiled_W = tf.tile(tf.expand_dims(W, 0), [tf.shape(inputs)[0], 1, 1])
-        tiled_b = tf.tile(tf.expand_dims(b, 0), [tf.shape(inputs)[0], 1, 1])
-        output = tf.matmul(inputs, tiled_W) + tiled_b
+        if len(W.get_shape()) == 3:
+            # per-trial matrices and biases, batch x in x out and batch x 1 x out
+            output = tf.matmul(inputs, W) + b
+        else:
+            tiled_W = tf.tile(tf.expand_dims(W, 0), [tf.shape(inputs)[0], 1, 1])
+            tiled_b = tf.tile(tf.expand_dims(b, 0), [tf.shape(inputs)[0], 1, 1])
+            output = tf.matmul(inputs, tiled_W) + tiled_b
 
         if nonlinearity is 'exp':
             output_nl = tf.exp(output)
@@ -623,6 +779,48 @@ class KLCost_GaussianGaussianProcessSampled(object):
     self.kl_cost_b = kl_b
 
 
+class LazyAdamOptimizer(tf.train.AdamOptimizer):
+    """Adam that updates only the rows a sparse gradient has (hps.lazy_session_adam).
+
+    For tf.IndexedSlices gradients, e.g. of a gathered variable, the moment
+    estimates and the variable are updated at the gradient's indices only,
+    instead of decaying every row's moments and moving every row. Other rows
+    are left as they are until they get a gradient again. Dense gradients get
+    the usual Adam update. The slots are the same as AdamOptimizer's, so
+    checkpoints are interchangeable.
+    """
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_lazy(grad.values, var, grad.indices)
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_lazy(grad, var, indices)
+
+    def _apply_lazy(self, grad, var, indices):
+        beta1_power, beta2_power = self._get_beta_accumulators()
+        dtype = var.dtype.base_dtype
+        beta1_power = tf.cast(beta1_power, dtype)
+        beta2_power = tf.cast(beta2_power, dtype)
+        beta1_t = tf.cast(self._beta1_t, dtype)
+        beta2_t = tf.cast(self._beta2_t, dtype)
+        epsilon_t = tf.cast(self._epsilon_t, dtype)
+        lr = tf.cast(self._lr_t, dtype) * tf.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+        # m := beta1 * m + (1 - beta1) * g, v := beta2 * v + (1 - beta2) * g^2, at the indices
+        m = self.get_slot(var, "m")
+        m_t = tf.scatter_update(m, indices, beta1_t * tf.gather(m, indices) + (1 - beta1_t) * grad,
+                                use_locking=self._use_locking)
+        v = self.get_slot(var, "v")
+        v_t = tf.scatter_update(v, indices, beta2_t * tf.gather(v, indices) + (1 - beta2_t) * tf.square(grad),
+                                use_locking=self._use_locking)
+        # var -= lr * m / (sqrt(v) + epsilon), at the indices
+        m_t_rows = tf.gather(m_t, indices)
+        v_t_rows = tf.gather(v_t, indices)
+        var_update = tf.scatter_sub(var, indices, lr * m_t_rows / (tf.sqrt(v_t_rows) + epsilon_t),
+                                    use_locking=self._use_locking)
+        return tf.group(var_update, m_t, v_t)
+
+
 """Wrappers for primitive Neural Net (NN) Operations."""
 
 import numbers
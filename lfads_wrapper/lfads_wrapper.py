@@ -8,8 +8,8 @@ from tensorflow.python.lib.io import file_io
 import ntpath
 
 from lfads_tf1.run_lfads_tf1 import hps_dict_to_obj, jsonify_dict
-from lfads_tf1.data_funcs import load_datasets
-from lfads_tf1.helper_funcs import kind_dict, kind_dict_key
+from lfads_tf1.data_funcs import load_datasets, ALIGNMENT_KEYS
+from lfads_tf1.helper_funcs import kind_dict, kind_dict_key, graph_run_type
 from lfads_tf1.models import LFADS
 import lfads_tf1.data_funcs as utils
 import warnings
@@ -25,6 +25,7 @@ class lfadsWrapper:
         self.datasets = None
         self.data_dir = None
         self.data_filename_stem = None
+        self.data_keys = None
 
     # copy hyperparameter files to a new directory
     def copy_hps( self, source_path, target_path ):
@@ -107,7 +108,8 @@ class lfadsWrapper:
         # change the kind str to kind number !!!
         hps.kind = kind_dict(hps.kind)
         hps.lfads_save_dir = ckpt_load_path
-        self.load_datasets_if_necessary(hps)
+        # only the shapes and alignment matrices are needed to build the graph
+        self.load_datasets_if_necessary(hps, keys=ALIGNMENT_KEYS)
         self.infer_dataset_properties(hps)
         fname = os.path.join(hps.lfads_save_dir, "model_params")
         tf.reset_default_graph()
@@ -193,12 +195,19 @@ class lfadsWrapper:
             assert 0, 'You must specify a heldout_samp or heldout_trial for recon cost!'
         return recon_cost, lfads_save_path
 
-    def load_datasets_if_necessary(self, hps):
+    def load_datasets_if_necessary(self, hps, keys=None):
+        # keys=None loads everything, a subset only loads those keys
         stem_changed = self.data_filename_stem != hps.data_filename_stem
         data_dir_changed = self.data_dir != hps.data_dir
-        if stem_changed or data_dir_changed:
+        keys = None if keys is None else frozenset(keys)
+        keys_missing = self.data_keys is not None and \
+            (keys is None or not keys <= self.data_keys)
+        if stem_changed or data_dir_changed or keys_missing:
             self.datasets = load_datasets(hps.data_dir,
-                                          hps.data_filename_stem, hps)
+                                          hps.data_filename_stem, hps, keys=keys)
+            self.data_dir = hps.data_dir
+            self.data_filename_stem = hps.data_filename_stem
+            self.data_keys = keys
 
     def write_model_runs(self, hps, datasets, output_fname=None):
         """Run the model on the data in data_dict, and save the computed values.
@@ -250,7 +259,8 @@ class lfadsWrapper:
 
     def build_model(self, hps, datasets=None, reuse=None ):
         with tf.variable_scope("LFADS", reuse=reuse):
-            model = LFADS(hps, datasets=datasets)
+            # the graph is built for the run type of hps.kind
+            model = LFADS(hps, datasets=datasets, run_type=graph_run_type(hps))
 
         if not os.path.exists(hps.lfads_save_dir):
             print("Save directory %s does not exist, creating it." % hps.lfads_save_dir)
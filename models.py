@@ -5,24 +5,27 @@ import tensorflow.compat.v1 as tf
 tf.disable_v2_behavior() # critical to suppress deprecation warnings
 import numpy as np
 import sys
+import copy
 import time
 import os
 import re
+import json
 #import matplotlib.pyplot as plt
 
 
 # utils defined by CP/MRK
 from lfads_tf1.helper_funcs import linear, init_linear_transform, makeInitialState
-from lfads_tf1.helper_funcs import ListOfRandomBatches, kind_dict, kind_dict_key
+from lfads_tf1.helper_funcs import EpochPlanner, kind_dict, kind_dict_key, run_type_samples_posterior
 from lfads_tf1.helper_funcs import LearnableAutoRegressive1Prior
 from lfads_tf1.helper_funcs import DiagonalGaussianFromExisting, LearnableDiagonalGaussian, diag_gaussian_log_likelihood
-from lfads_tf1.helper_funcs import LinearTimeVarying
+from lfads_tf1.helper_funcs import LinearTimeVarying, LazyAdamOptimizer
 from lfads_tf1.helper_funcs import KLCost_GaussianGaussian, KLCost_GaussianGaussianProcessSampled
-from lfads_tf1.data_funcs import write_data
+from lfads_tf1.data_funcs import write_data, input_data_dtype, cast_count_data, SparseSpikeData
+from lfads_tf1.data_funcs import is_out_of_core, shuffle_block_size, ReadAheadBatches, prefetch
 from lfads_tf1.helper_funcs import printer, mkdir_p, write_code_commit
 #from plot_funcs import plot_data, close_all_plots
 #from data_funcs import read_datasets
-from lfads_tf1.customcells import ComplexCell
+from lfads_tf1.customcells import ComplexCell, ComplexCellStateTuple
 from lfads_tf1.rnn_helper_funcs import BidirectionalDynamicRNN #, DynamicRNN
 from lfads_tf1.helper_funcs import dropout
 
@@ -39,6 +42,28 @@ def _case_with_no_default(pairs):
             return tf.identity(pairs[0][1]())
     return tf.case(pairs, _default_value_fn, exclusive=True)
 
+# alignment matrix and bias of a dataset, to initialize its read-in (and read-out)
+def _alignment_init_values(data_dict, data_dim, in_factors_dim):
+    in_mat_cxf = None
+    align_bias_1xc = None
+    # get the alignment_matrix if provided
+    if 'alignment_matrix_cxf' in data_dict.keys():
+        in_mat_cxf = data_dict[ 'alignment_matrix_cxf'].astype( np.float32 )
+        # check that sizing is appropriate
+        if in_mat_cxf.shape != (data_dim, in_factors_dim):
+            raise ValueError("""Alignment matrix must have dimensions %d x %d
+            (data_dim x factors_dim), but currently has %d x %d."""%
+                             (data_dim, in_factors_dim, in_mat_cxf.shape[0],
+                              in_mat_cxf.shape[1]))
+    if 'alignment_bias_c' in data_dict.keys():
+        align_bias_c = data_dict[ 'alignment_bias_c'].astype( np.float32 )
+        align_bias_1xc = np.expand_dims(align_bias_c, axis=0)
+        if align_bias_1xc.shape[1] != data_dim:
+            raise ValueError("""Alignment bias must have dimensions %d
+            (data_dim), but currently has %d."""%
+                             (data_dim, in_mat_cxf.shape[0]))
+    return in_mat_cxf, align_bias_1xc
+
 #class Logger(object):
 #    def __init__(self, log_file):
 #        self.terminal = sys.stdout
@@ -72,16 +97,15 @@ class Logger(object):
 
 class LFADS(object):
 
-    def __init__(self, hps, datasets = None):
-        # Cell type only for encoders:
-        #CELL_TYPE = 'lstm' # not working
-        #CELL_TYPE = 'gru'
-        CELL_TYPE = 'customgru'
-
-        # to stop certain gradients paths through the graph in backprop
-        def entry_stop_gradients(target, mask):
-            mask_h = 1. - mask
-            return tf.stop_gradient(mask_h * target) + mask * target
+    def __init__(self, hps, datasets = None, run_type = None):
+        # run_type ('train', 'posterior_sample_and_average' or 'posterior_mean', see
+        #  helper_funcs.graph_run_type) builds the graph for that run type only: the
+        #  posteriors are always sampled, or their means always passed, instead of
+        #  picking one with a tf.cond on the fed self.run_type (at every step in the
+        #  ComplexCell). None builds the graph for all run types.
+        self.graph_run_type = run_type
+        self.graph_samples_posterior = None if run_type is None else \
+            run_type_samples_posterior(kind_dict(run_type))
 
         # save the stdout to a log file and prints it on the screen
         mkdir_p(hps['lfads_save_dir'])
@@ -116,11 +140,51 @@ class LFADS(object):
             # input data (what are we training on)
             # we're going to try setting input dimensionality to None
             #  so datasets with different sizes can be used
-            self.dataset_ph = tf.placeholder(tf.float32, shape = [None, hps['num_steps'], None], name='input_data')
-            self.cv_rand_mask_ph = tf.placeholder(tf.float32, shape=[None, hps['num_steps'], None], name='cv_rand_mask')
+            # spike counts may be fed as uint8/uint16 and are cast on the device
+            input_dtype = tf.as_dtype(input_data_dtype(datasets))
+            # (build_feed_dict checks fed data against it, see cast_count_data)
+            self.input_data_dtype = input_dtype.as_numpy_dtype
+            # sparse batches (SparseSpikeData) are fed in COO form and densified on the device
+            self.dataset_sparse_ph = tf.SparseTensor(
+                tf.placeholder_with_default(tf.zeros([0, 3], tf.int64), shape=[None, 3], name='input_data_indices'),
+                tf.placeholder_with_default(tf.zeros([0], input_dtype), shape=[None], name='input_data_values'),
+                tf.placeholder_with_default(tf.constant([0, hps['num_steps'], 0], tf.int64), shape=[3],
+                                            name='input_data_dense_shape'))
+            input_mode = hps.get('input_mode', 'feed_dict')
+            session_params = hps.get('session_params', 'case')
+            if hps.get('mix_session_batches', False) and \
+               (session_params != 'stacked' or input_mode != 'feed_dict'):
+                raise ValueError("mix_session_batches needs session_params 'stacked' and input_mode 'feed_dict'")
+            self.input_iterator = None
+            self.device_datasets = None
+            if input_mode == 'tf_data':
+                # run_epoch's batches come from a tf.data pipeline; the placeholders
+                #  default to its output and can still be fed as usual
+                self.input_iterator = self.build_input_pipeline(hps, input_dtype)
+                input_name, input_data, input_mask, input_ext = self.input_iterator.get_next()
+            elif input_mode == 'device' and datasets and \
+                 all('train_data' in data_dict for data_dict in datasets.values()):
+                # the datasets live in graph variables, run_epoch feeds trial indices
+                self.dataName = tf.placeholder(tf.string, shape=(), name='dataset_name')
+                input_data, input_mask, input_ext = self.build_device_datasets(hps, datasets, input_dtype)
+            else:
+                # feeding dense data directly skips the densify
+                input_data = tf.sparse.to_dense(self.dataset_sparse_ph)
+            # True if unfed inputs default to run_epoch's batch
+            self.inputs_from_graph = self.input_iterator is not None or self.device_datasets is not None
+            self.dataset_ph = tf.placeholder_with_default(input_data,
+                                                          shape = [None, hps['num_steps'], None], name='input_data')
+            self.dataset_float = tf.cast(self.dataset_ph, tf.float32) if input_dtype != tf.float32 else self.dataset_ph
+            # defaults to all ones (nothing held out) when no mask is fed
+            self.cv_rand_mask_ph = tf.placeholder_with_default(
+                input_mask if self.inputs_from_graph else tf.ones_like(self.dataset_float),
+                shape=[None, hps['num_steps'], None], name='cv_rand_mask')
             # dropout keep probability
             #   enumerated in helper_funcs.kind_dict
             self.keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+            # graphs built only for evaluation (see run_type) have no dropout,
+            #  and draw no dropout masks
+            dropout_keep_prob = self.keep_prob if self.graph_run_type in [None, 'train'] else 1.0
             self.keep_ratio = tf.placeholder(tf.float32, name='keep_ratio')
             self.cv_keep_ratio = tf.placeholder(tf.float32, name='cv_keep_ratio')
 
@@ -132,16 +196,145 @@ class LFADS(object):
             self.l2_weight = tf.placeholder(tf.float32, name='l2_weight')
 
             # name of the dataset
-            self.dataName = tf.placeholder(tf.string, shape=(), name='dataset_name')
+            if self.input_iterator is not None:
+                self.dataName = tf.placeholder_with_default(input_name, shape=(), name='dataset_name')
+            elif self.device_datasets is None and session_params == 'stacked':
+                # mixed batches feed session_idx instead
+                self.dataName = tf.placeholder_with_default('', shape=(), name='dataset_name')
+            elif self.device_datasets is None:
+                self.dataName = tf.placeholder(tf.string, shape=(), name='dataset_name')
             if hps['ext_input_dim'] > 0:
-                self.ext_input_ph = tf.placeholder(tf.float32,
-                                      [None, hps['num_steps'], hps['ext_input_dim']],
-                                      name="ext_input")
-                self.ext_input = self.ext_input_ph[:, hps.ic_enc_seg_len:, :]
-                self.ext_input = tf.nn.dropout(self.ext_input, self.keep_prob)
+                if not self.inputs_from_graph:
+                    self.ext_input_ph = tf.placeholder(tf.float32,
+                                          [None, hps['num_steps'], hps['ext_input_dim']],
+                                          name="ext_input")
+                else:
+                    self.ext_input_ph = tf.placeholder_with_default(input_ext,
+                                          [None, hps['num_steps'], hps['ext_input_dim']],
+                                          name="ext_input")
             else:
                 self.ext_input_ph = None
-                self.ext_input = None
+
+            # session index of each trial, with 'stacked' session params (see
+            #  build_stacked_session_params). all trials are the named dataset's by default
+            self.session_idx = None
+            if session_params == 'stacked':
+                name_idx = tf.argmax(tf.cast(tf.equal(tf.constant(hps.dataset_names), self.dataName), tf.int32),
+                                     output_type=tf.int32)
+                self.session_idx = tf.placeholder_with_default(tf.fill(tf.shape(self.dataset_ph)[:1], name_idx),
+                                                               shape=[None], name='session_idx')
+
+        # the model, from its inputs to the clipped gradients of the costs
+        self.build_step(hps, datasets, dropout_keep_prob)
+
+        # this is the optimizer
+        #self.opt = tf.train.AdamOptimizer(self.learning_rate)
+        if hps.get('lazy_session_adam', False):
+            # (build_step makes the read-in/read-out gradients sparse)
+            self.opt = LazyAdamOptimizer(self.learning_rate, beta1=hps['beta1'], beta2=hps['beta2'],
+                                         epsilon=hps['adam_epsilon'])
+        else:
+            self.opt = tf.train.AdamOptimizer(self.learning_rate, beta1=hps['beta1'], beta2=hps['beta2'], epsilon=hps['adam_epsilon'])
+        #, beta1=0.9, beta2=0.999, epsilon=1e-01)
+
+        # global that holds current step number
+        self.train_step = tf.get_variable("global_step", [], tf.int64,
+                                     tf.zeros_initializer(),
+                                     trainable=False)
+        self.train_op = self.opt.apply_gradients(
+            zip(self.gradients, self.trainable_vars), global_step = self.train_step)
+
+        # streaming (batch size weighted) means of the costs over an epoch, so that
+        #  steps do not have to fetch them (see run_epoch): reset_cost_sums_op resets,
+        #  accumulate_costs_op updates, mean_costs reads. kept out of the checkpoints
+        with tf.variable_scope('cost_sums'):
+            self.cost_sums = tf.Variable(tf.zeros([6], tf.float64), trainable=False,
+                                         collections=[], name='sums')
+            self.cost_weight = tf.Variable(tf.zeros([], tf.float64), trainable=False,
+                                           collections=[], name='weight')
+            self.reset_cost_sums_op = tf.variables_initializer([self.cost_sums, self.cost_weight])
+            self.accumulate_costs_op = self.accumulate_costs(self)
+            self.mean_costs = self.cost_sums / self.cost_weight
+
+        # several training steps per session.run, with device datasets (see run_epoch)
+        self.fused_train_op = None
+        if hps.get('fused_train_steps', 0) > 1 and self.device_datasets is not None and \
+           self.graph_run_type in [None, 'train']:
+            self.fused_train_op = self.build_fused_train_op(hps, datasets, dropout_keep_prob)
+
+        # hooks to save down model checkpoints:
+        # "save every so often" (i.e., recent checkpoints)
+        self.seso_saver = tf.train.Saver(tf.global_variables(),
+                                     max_to_keep=hps.max_ckpt_to_keep)
+
+        # lowest validation error checkpoint
+        self.lve_saver = tf.train.Saver(tf.global_variables(),
+                                    max_to_keep=hps.max_ckpt_to_keep)
+        
+        # store the hps
+        self.hps = hps
+        # batch order (see get_epoch_planner)
+        self.batch_seed = hps.get('batch_seed', -1)
+        if self.batch_seed < 0:
+            self.batch_seed = np.random.randint(2**31 - 1)
+        self._epoch_planners = {}
+        # train_model's state at the start of the current training epoch, saved
+        #  with the checkpoints taken within the epoch (see hps.ckpt_save_steps)
+        self._epoch_start_state = None
+        # Session.make_callable's made by run_step
+        self._step_fns = {}
+        self._step_fns_session = None
+
+
+        # Don't print this?
+        '''
+        print("Model Variables (to be optimized): ")
+        total_params = 0
+        tvars = self.trainable_vars
+        for i in range(len(tvars)):
+            shape = tvars[i].get_shape().as_list()
+            print("- ", i, tvars[i].name, shape)
+            total_params += np.prod(shape)
+        print("Total model parameters: ", total_params)
+        '''
+        
+        self.merged_generic = tf.summary.merge_all() # default key is 'summaries'
+        session = tf.get_default_session()
+        self.logfile = os.path.join(hps.lfads_save_dir, "lfads_log")
+        self.writer = tf.summary.FileWriter(self.logfile, session.graph)
+
+        if self.device_datasets is not None:
+            self.upload_device_datasets()
+
+        
+    def build_step(self, hps, datasets, dropout_keep_prob, reuse=None):
+        """Build one step of the model: from its inputs (self.dataName,
+        self.dataset_ph, self.dataset_float, self.cv_rand_mask_ph,
+        self.ext_input_ph and self.session_idx) through the encoders, the
+        ComplexCell and the rates to the costs and their clipped gradients
+        (self.gradients, self.grad_global_norm).
+
+        With reuse, the variables of an earlier build are used, so a second
+        build (on a copy of the model with other inputs, see
+        build_fused_train_op) shares all of its parameters with the first.
+        """
+
+        # Cell type only for encoders:
+        #CELL_TYPE = 'lstm' # not working
+        #CELL_TYPE = 'gru'
+        CELL_TYPE = 'customgru'
+
+        # to stop certain gradients paths through the graph in backprop
+        def entry_stop_gradients(target, mask):
+            mask_h = 1. - mask
+            return tf.stop_gradient(mask_h * target) + mask * target
+
+        session_params = hps.get('session_params', 'case')
+        if self.ext_input_ph is not None:
+            self.ext_input = self.ext_input_ph[:, hps.ic_enc_seg_len:, :]
+            self.ext_input = tf.nn.dropout(self.ext_input, dropout_keep_prob)
+        else:
+            self.ext_input = None
 
         # make placeholders for all the input and output adapter matrices
         ndatasets = hps.ndatasets
@@ -155,6 +348,8 @@ class LFADS(object):
         # specific to lfadslite - need to make placeholders for the cross validation dropout masks
         #dataset_dims = [None] * ndatasets
         fns_this_dataset_dims = [None] * ndatasets
+        # per-session variable name -> pred, for hps.lazy_session_adam
+        session_var_preds = {}
 
 
         # figure out the input (dataset) dimensionality
@@ -163,121 +358,125 @@ class LFADS(object):
         
         self.cd_grad_passthru_prob = hps['cd_grad_passthru_prob']
 
-        ## do per-session stuff
-        for d, name in enumerate( dataset_names ):
-            data_dim = hps.dataset_dims[name]
+        if session_params == 'stacked':
+            # all sessions' parameters in one set of variables, picked per trial
+            this_dataset_in_fac_W, this_dataset_in_fac_b, this_dataset_out_fac_W, this_dataset_out_fac_b, \
+                this_dataset_dims_bxtxc = self.build_stacked_session_params(hps, datasets)
+            output_size = this_dataset_out_fac_W.get_shape().as_list()[2]
+        else:
+            ## do per-session stuff
+            for d, name in enumerate( dataset_names ):
+                data_dim = hps.dataset_dims[name]
 
-            # Step 0) define the preds comparator for this dataset
-            preds[ d ] = tf.equal( tf.constant( name ), self.dataName )
+                # Step 0) define the preds comparator for this dataset
+                preds[ d ] = tf.equal( tf.constant( name ), self.dataName )
             
-            # Step 1) alignment matrix stuff.
-            # the alignment matrix only matters if in_factors_dim is nonzero
-            in_mat_cxf = None
-            align_bias_1xc = None
-            in_bias_1xf = None
-            if hps.in_factors_dim > 0:
-                # get the alignment_matrix if provided
-                if 'alignment_matrix_cxf' in datasets[ name ].keys():
-                    in_mat_cxf = datasets[ name ][ 'alignment_matrix_cxf'].astype( np.float32 )
-                    # check that sizing is appropriate
-                    if in_mat_cxf.shape != (data_dim, hps.in_factors_dim):
-                        raise ValueError("""Alignment matrix must have dimensions %d x %d
-                        (data_dim x factors_dim), but currently has %d x %d."""%
-                                         (data_dim, hps.in_factors_dim, in_mat_cxf.shape[0],
-                                          in_mat_cxf.shape[1]))
-                if 'alignment_bias_c' in datasets[ name ].keys():
-                    align_bias_c = datasets[ name ][ 'alignment_bias_c'].astype( np.float32 )
-                    align_bias_1xc = np.expand_dims(align_bias_c, axis=0)
-                    if align_bias_1xc.shape[1] != data_dim:
-                        raise ValueError("""Alignment bias must have dimensions %d
-                        (data_dim), but currently has %d."""%
-                                         (data_dim, in_mat_cxf.shape[0]))
-                if in_mat_cxf is not None and align_bias_1xc is not None:
-                    # (data - alignment_bias) * W_in
-                    # data * W_in - alignment_bias * W_in
-                    # So b = -alignment_bias * W_in to accommodate PCA style offset.
-                    in_bias_1xf = -np.dot(align_bias_1xc, in_mat_cxf)
-                # initialize a linear transform based on the above
-                in_fac_linear = init_linear_transform( data_dim, hps.in_factors_dim, mat_init_value=in_mat_cxf,
-                                                       bias_init_value=in_bias_1xf,
-                                                       name= name+'_in_fac_linear' )
-                in_fac_W, in_fac_b = in_fac_linear
-                # to store per-session matrices/biases for later use, need to use 'makelambda'
-                fns_in_fac_Ws[d] = makelambda(in_fac_W)
-                fns_in_fac_bs[d] = makelambda(in_fac_b)
+                # Step 1) alignment matrix stuff.
+                # the alignment matrix only matters if in_factors_dim is nonzero
+                in_mat_cxf = None
+                align_bias_1xc = None
+                in_bias_1xf = None
+                if hps.in_factors_dim > 0:
+                    in_mat_cxf, align_bias_1xc = _alignment_init_values(datasets[ name ], data_dim,
+                                                                        hps.in_factors_dim)
+                    if in_mat_cxf is not None and align_bias_1xc is not None:
+                        # (data - alignment_bias) * W_in
+                        # data * W_in - alignment_bias * W_in
+                        # So b = -alignment_bias * W_in to accommodate PCA style offset.
+                        in_bias_1xf = -np.dot(align_bias_1xc, in_mat_cxf)
+                    # initialize a linear transform based on the above
+                    in_fac_linear = init_linear_transform( data_dim, hps.in_factors_dim, mat_init_value=in_mat_cxf,
+                                                           bias_init_value=in_bias_1xf,
+                                                           name= name+'_in_fac_linear' )
+                    in_fac_W, in_fac_b = in_fac_linear
+                    session_var_preds[in_fac_W.name] = session_var_preds[in_fac_b.name] = preds[d]
+                    # to store per-session matrices/biases for later use, need to use 'makelambda'
+                    fns_in_fac_Ws[d] = makelambda(in_fac_W)
+                    fns_in_fac_bs[d] = makelambda(in_fac_b)
                 
-            # single-sample cross-validation mask
-            # generate one random mask once (for each dataset) when building the graph
-            # use a different (but deterministic) random seed for each dataset (hence adding 'd' below)
-            #if hps.cv_rand_seed:
-            #    np.random.seed( int(hps.cv_rand_seed) + d)
-
-            # Step 2) make a get the dataset dim (work around dim error in dynamic rnn)
-            #dataset_dims[ d ] = hps.dataset_dims[ name ]
-            # converting to tensor
-            fns_this_dataset_dims[ d ] = makelambda( tf.ones((hps['num_steps'], hps.dataset_dims[ name ])) )
-
-            #reset the np random seed to enforce randomness for the other random draws
-            #np.random.seed()
+                # single-sample cross-validation mask
+                # generate one random mask once (for each dataset) when building the graph
+                # use a different (but deterministic) random seed for each dataset (hence adding 'd' below)
+                #if hps.cv_rand_seed:
+                #    np.random.seed( int(hps.cv_rand_seed) + d)
+
+                # Step 2) make a get the dataset dim (work around dim error in dynamic rnn)
+                #dataset_dims[ d ] = hps.dataset_dims[ name ]
+                # converting to tensor
+                fns_this_dataset_dims[ d ] = makelambda( tf.ones((hps['num_steps'], hps.dataset_dims[ name ])) )
+
+                #reset the np random seed to enforce randomness for the other random draws
+                #np.random.seed()
             
-            # Step 3) output matrix stuff
-            out_mat_fxc = None
-            out_bias_1xc = None
+                # Step 3) output matrix stuff
+                out_mat_fxc = None
+                out_bias_1xc = None
             
-            # if input and output factors dims match, can initialize output matrices using transpose of input matrices
-            if in_mat_cxf is not None:
-                if hps.in_factors_dim==hps.factors_dim:
-                    out_mat_fxc = in_mat_cxf.T
-            if align_bias_1xc is not None:
-                out_bias_1xc = align_bias_1xc
+                # if input and output factors dims match, can initialize output matrices using transpose of input matrices
+                if in_mat_cxf is not None:
+                    if hps.in_factors_dim==hps.factors_dim:
+                        out_mat_fxc = in_mat_cxf.T
+                if align_bias_1xc is not None:
+                    out_bias_1xc = align_bias_1xc
             
-            if hps.output_dist.lower() == 'poisson':
-                output_size = data_dim
-            elif hps.output_dist.lower() == 'gaussian':
-                output_size = data_dim * 2
-                if out_mat_fxc is not None:
-                    out_mat_fxc = tf.concat( [ out_mat_fxc, out_mat_fxc ], 0 )
-                if out_bias_1xc is not None:
-                    out_bias_1xc = tf.concat( [ out_bias_1xc, out_bias_1xc ], 0 )
-            elif hps.output_dist.lower() == 'inverse-gamma':
-                output_size = data_dim * 2
-                if out_mat_fxc is not None:
-                    out_mat_fxc = tf.concat( [ out_mat_fxc, out_mat_fxc ], 0 )
-                if out_bias_1xc is not None:
-                    out_bias_1xc = tf.concat( [ out_bias_1xc, out_bias_1xc ], 0 )
+                if hps.output_dist.lower() == 'poisson':
+                    output_size = data_dim
+                elif hps.output_dist.lower() == 'gaussian':
+                    output_size = data_dim * 2
+                    if out_mat_fxc is not None:
+                        out_mat_fxc = tf.concat( [ out_mat_fxc, out_mat_fxc ], 0 )
+                    if out_bias_1xc is not None:
+                        out_bias_1xc = tf.concat( [ out_bias_1xc, out_bias_1xc ], 0 )
+                elif hps.output_dist.lower() == 'inverse-gamma':
+                    output_size = data_dim * 2
+                    if out_mat_fxc is not None:
+                        out_mat_fxc = tf.concat( [ out_mat_fxc, out_mat_fxc ], 0 )
+                    if out_bias_1xc is not None:
+                        out_bias_1xc = tf.concat( [ out_bias_1xc, out_bias_1xc ], 0 )
                     
-            out_fac_linear = init_linear_transform( hps.factors_dim, output_size, mat_init_value=out_mat_fxc,
-                                                   bias_init_value=out_bias_1xc,
-                                                   name= name+'_out_fac_linear' )
-            out_fac_W, out_fac_b = out_fac_linear
-            fns_out_fac_Ws[d] = makelambda(out_fac_W)
-            fns_out_fac_bs[d] = makelambda(out_fac_b)
-
-        # now 'zip' together the 'pred' selector with all the function handles
-
-        pf_pairs_in_fac_Ws = tuple(zip(preds, fns_in_fac_Ws))
-        pf_pairs_in_fac_bs = tuple(zip(preds, fns_in_fac_bs))
-        pf_pairs_out_fac_Ws = tuple(zip(preds, fns_out_fac_Ws))
-        pf_pairs_out_fac_bs = tuple(zip(preds, fns_out_fac_bs))
-        pf_pairs_this_dataset_dims = tuple(zip(preds, fns_this_dataset_dims ))
-
-        # now, choose the ones for this session
-        if hps.in_factors_dim > 0:
-            this_dataset_in_fac_W = _case_with_no_default( pf_pairs_in_fac_Ws )
-            this_dataset_in_fac_b = _case_with_no_default( pf_pairs_in_fac_bs )
+                out_fac_linear = init_linear_transform( hps.factors_dim, output_size, mat_init_value=out_mat_fxc,
+                                                       bias_init_value=out_bias_1xc,
+                                                       name= name+'_out_fac_linear' )
+                out_fac_W, out_fac_b = out_fac_linear
+                session_var_preds[out_fac_W.name] = session_var_preds[out_fac_b.name] = preds[d]
+                fns_out_fac_Ws[d] = makelambda(out_fac_W)
+                fns_out_fac_bs[d] = makelambda(out_fac_b)
+
+            # now 'zip' together the 'pred' selector with all the function handles
+
+            pf_pairs_in_fac_Ws = tuple(zip(preds, fns_in_fac_Ws))
+            pf_pairs_in_fac_bs = tuple(zip(preds, fns_in_fac_bs))
+            pf_pairs_out_fac_Ws = tuple(zip(preds, fns_out_fac_Ws))
+            pf_pairs_out_fac_bs = tuple(zip(preds, fns_out_fac_bs))
+            pf_pairs_this_dataset_dims = tuple(zip(preds, fns_this_dataset_dims ))
+
+            # now, choose the ones for this session
+            if hps.in_factors_dim > 0:
+                this_dataset_in_fac_W = _case_with_no_default( pf_pairs_in_fac_Ws )
+                this_dataset_in_fac_b = _case_with_no_default( pf_pairs_in_fac_bs )
 
-        this_dataset_out_fac_W = _case_with_no_default( pf_pairs_out_fac_Ws )
-        this_dataset_out_fac_b = _case_with_no_default( pf_pairs_out_fac_bs )
-        this_dataset_dims = _case_with_no_default( pf_pairs_this_dataset_dims )
+            this_dataset_out_fac_W = _case_with_no_default( pf_pairs_out_fac_Ws )
+            this_dataset_out_fac_b = _case_with_no_default( pf_pairs_out_fac_bs )
+            this_dataset_dims = _case_with_no_default( pf_pairs_this_dataset_dims )
                 
 
         graph_batch_size = tf.shape(self.dataset_ph)[0]
 
+        dataset_float, cv_rand_mask_ph = self.dataset_float, self.cv_rand_mask_ph
+        if session_params == 'stacked':
+            # batches with fewer channels than the most are zero-padded
+            def pad_channels(x):
+                x = tf.pad(x, [[0, 0], [0, 0], [0, self.max_data_dim - tf.shape(x)[2]]])
+                x.set_shape([None, hps['num_steps'], self.max_data_dim])
+                return x
+            dataset_float, cv_rand_mask_ph = pad_channels(dataset_float), pad_channels(cv_rand_mask_ph)
+        else:
+            this_dataset_dims_bxtxc = tf.expand_dims(tf.ones([graph_batch_size, 1]), 1) * this_dataset_dims
+
         # apply dropout to the data
-        self.dataset_in_orig = self.dataset_ph * \
-                          tf.expand_dims(tf.ones([graph_batch_size, 1]), 1) * this_dataset_dims
+        self.dataset_in_orig = dataset_float * this_dataset_dims_bxtxc
         # batch_size - read from the data placeholder
-        self.dataset_in = tf.nn.dropout(self.dataset_in_orig, rate=1-self.keep_prob)
+        self.dataset_in = tf.nn.dropout(self.dataset_in_orig, rate=1-dropout_keep_prob)
         # can we infer the data dimensionality for the random mask?
         full_seq_len = hps.num_steps
         if hps.ic_enc_seg_len > 0:
@@ -305,10 +504,9 @@ class LFADS(object):
         # define the SV noise type
         sv_mask_type = 'zeros'
         if hps.cv_keep_ratio < 1.0:
-            self.cv_rand_mask = self.cv_rand_mask_ph[:, hps.ic_enc_seg_len:, :]
+            self.cv_rand_mask = cv_rand_mask_ph[:, hps.ic_enc_seg_len:, :]
             self.cv_binary_mask_batch = self.cv_rand_mask * \
-                                        tf.expand_dims(tf.ones([graph_batch_size, 1]), 1) * \
-                                        this_dataset_dims[hps.ic_enc_seg_len:, :]
+                                        this_dataset_dims_bxtxc[:, hps.ic_enc_seg_len:, :]
 
             # MRK: apply cross-validation dropout
             if sv_mask_type == 'zeros':
@@ -326,10 +524,9 @@ class LFADS(object):
                                         ),
                                         [1, 0, 2])
         else:
-            self.cv_rand_mask = tf.ones_like(self.cv_rand_mask_ph[:, hps.ic_enc_seg_len:, :])
+            self.cv_rand_mask = tf.ones_like(cv_rand_mask_ph[:, hps.ic_enc_seg_len:, :])
             self.cv_binary_mask_batch = self.cv_rand_mask * \
-                                        tf.expand_dims(tf.ones([graph_batch_size, 1]), 1) * \
-                                        this_dataset_dims[hps.ic_enc_seg_len:, :]
+                                        this_dataset_dims_bxtxc[:, hps.ic_enc_seg_len:, :]
 
 
         # MRK: if hps.ic_enc_seg_len is 0, switch to non-causal mode
@@ -374,12 +571,13 @@ class LFADS(object):
                 initial_state = None,
                 clip_value = hps['cell_clip_value'],
                 recurrent_collections='l2_ic_enc',
-                rnn_type = CELL_TYPE)
+                rnn_type = CELL_TYPE,
+                reuse = reuse)
 
 
             # wrap the last state with a dropout layer
             #ic_enc_laststate_dropped = self.ic_enc_rnn_obj.last_tot
-            ic_enc_laststate_dropped = tf.nn.dropout(self.ic_enc_rnn_obj.last_tot, self.keep_prob)
+            ic_enc_laststate_dropped = tf.nn.dropout(self.ic_enc_rnn_obj.last_tot, dropout_keep_prob)
             
             # map the ic_encoder onto the actual ic layer
             ics_mean = linear(ic_enc_laststate_dropped, hps.ic_dim, name='ic_enc_2_ics_mean')
@@ -390,10 +588,15 @@ class LFADS(object):
             self.posterior_zs_g0 = self.gen_ics_posterior
 
         # to go forward, either sample from the posterior, or push the mean
-        do_posterior_sample = tf.logical_or(tf.equal(self.run_type, tf.constant(kind_dict("train"))),
-            tf.equal(self.run_type, tf.constant(kind_dict("posterior_sample_and_average"))))
-        self.gen_ics_lowd = tf.cond(do_posterior_sample, lambda:self.gen_ics_posterior.sample,
-            lambda:self.gen_ics_posterior.mean)
+        if self.graph_samples_posterior is None:
+            do_posterior_sample = tf.logical_or(tf.equal(self.run_type, tf.constant(kind_dict("train"))),
+                tf.equal(self.run_type, tf.constant(kind_dict("posterior_sample_and_average"))))
+            self.gen_ics_lowd = tf.cond(do_posterior_sample, lambda:self.gen_ics_posterior.sample,
+                lambda:self.gen_ics_posterior.mean)
+        elif self.graph_samples_posterior:
+            self.gen_ics_lowd = self.gen_ics_posterior.sample
+        else:
+            self.gen_ics_lowd = self.gen_ics_posterior.mean
 
 
         
@@ -435,7 +638,7 @@ class LFADS(object):
             with tf.variable_scope('factors'):
                 # wrap the generator states in a dropout layer
                 #gen_states_dropped = self.gen_rnn_obj.states
-                gen_states_dropped = tf.nn.dropout(self.gen_rnn_obj.states, self.keep_prob)
+                gen_states_dropped = tf.nn.dropout(self.gen_rnn_obj.states, dropout_keep_prob)
                 ## factors
                 self.fac_obj = LinearTimeVarying(inputs = gen_states_dropped,
                                                  output_size = hps['factors_dim'],
@@ -465,7 +668,8 @@ class LFADS(object):
                     initial_state = None,
                     rnn_type = CELL_TYPE,
                     recurrent_collections='l2_ci_enc',
-                    clip_value = hps['cell_clip_value'])
+                    clip_value = hps['cell_clip_value'],
+                    reuse = reuse)
                 
                 toffset = hps['controller_input_lag']
 
@@ -506,28 +710,6 @@ class LFADS(object):
                                               graph_batch_size,
                                               'controller')
 
-            # MRK we shouldn't initialize anything other than con_state as trainable
-            # the rest of initial states in ComplexCell are not used for anything
-            co_mean_init_state = tf.zeros(tf.stack([graph_batch_size, hps['co_dim']]))
-            co_logvar_init_state = tf.zeros(tf.stack([graph_batch_size, hps['co_dim']]))
-            co_sample_init_state = tf.zeros(tf.stack([graph_batch_size, hps['co_dim']]))
-            fac_init_state = tf.zeros(tf.stack([graph_batch_size, hps['factors_dim']]))
-
-            comcell_init_state = [self.gen_ics, con_init_state,
-                                       co_mean_init_state, co_logvar_init_state,
-                                       co_sample_init_state, fac_init_state]
-
-            self.complexcell_init_state = tf.concat(axis=1, values = comcell_init_state)
-
-            # here is what the state vector will look like
-            self.comcell_state_dims = [hps['gen_dim'],
-                                       used_con_dim,
-                                       hps['co_dim'], # for the controller output means
-                                       hps['co_dim'], # for the variances
-                                       hps['co_dim'], # for the sampled controller output
-                                       hps['factors_dim']]
-
-
             # construct the complexcell
             self.complexcell=ComplexCell(num_units_gen=hps['gen_dim'],
                                          num_units_con=used_con_dim,
@@ -536,8 +718,11 @@ class LFADS(object):
                                          ext_input_dim=hps['ext_input_dim'],
                                          inject_ext_input_to_gen=True,
                                          run_type = self.run_type,
-                                         keep_prob=self.keep_prob,
+                                         keep_prob=dropout_keep_prob,
                                          clip_value=hps['cell_clip_value'],
+                                         do_posterior_sample=self.graph_samples_posterior,
+                                         state_is_tuple=True,
+                                         reuse=reuse,
                                          )
 
             # construct the actual RNN
@@ -547,19 +732,52 @@ class LFADS(object):
                 complex_cell_inputs = tf.concat(axis=2, values = [self.ci_enc_outputs, self.ext_input])
             else:
                 complex_cell_inputs = self.ci_enc_outputs
+            with tf.variable_scope('rnn') as rnn_scope:
+                # the controller's share of the inputs doesn't depend on the
+                #  state, project it for all timesteps before the loop
+                #  (this also builds the cell)
+                complex_cell_inputs = self.complexcell.project_con_inputs(complex_cell_inputs)
+                if hps.get('predraw_cell_noise', False):
+                    # the cell's dropout masks and controller output noise, drawn
+                    #  for all timesteps at once, come in with the inputs
+                    complex_cell_inputs = self.complexcell.draw_noise(complex_cell_inputs)
+                # the cell carries the factors it feeds back to the controller in its
+                #  state, the first ones come from the initial generator state
+                fac_init_state = self.complexcell.gen_2_fac(self.gen_ics)
+
+            # MRK we shouldn't initialize anything other than con_state as trainable
+            # the co initial states in ComplexCell are not used for anything
+            co_mean_init_state = tf.zeros(tf.stack([graph_batch_size, hps['co_dim']]))
+            co_logvar_init_state = tf.zeros(tf.stack([graph_batch_size, hps['co_dim']]))
+            co_sample_init_state = tf.zeros(tf.stack([graph_batch_size, hps['co_dim']]))
+
+            comcell_init_state = [self.gen_ics, con_init_state,
+                                       co_mean_init_state, co_logvar_init_state,
+                                       co_sample_init_state, fac_init_state]
+
+            # the state is a tuple of the parts, carried without concatenating them
+            self.complexcell_init_state = ComplexCellStateTuple(*comcell_init_state)
+
+            # here is what the state tuple will look like
+            self.comcell_state_dims = [hps['gen_dim'],
+                                       used_con_dim,
+                                       hps['co_dim'], # for the controller output means
+                                       hps['co_dim'], # for the variances
+                                       hps['co_dim'], # for the sampled controller output
+                                       hps['factors_dim']]
+
             self.complex_outputs, self.complex_final_state =\
             tf.nn.dynamic_rnn(self.complexcell,
                               inputs = complex_cell_inputs,
                               initial_state = self.complexcell_init_state,
-                              dtype=tf.float32)
+                              dtype=tf.float32,
+                              scope=rnn_scope)
 
-            # split the states of the individual RNNs
-            # from the packed "complexcell" state
+            # the states of the individual RNNs
+            # from the "complexcell" state tuple
 
             self.gen_states, self.con_states, self.co_mean_states, self.co_logvar_states, self.controller_outputs, self.factors =\
-            tf.split(self.complex_outputs,
-                     self.comcell_state_dims,
-                     axis=2)
+            self.complex_outputs
             
             # MRK, this was for testing with for-loop graph construction of complexcell
             #if hps['ext_input_dim']:
@@ -690,14 +908,22 @@ class LFADS(object):
             self.loglikelihood_b_t = diag_gaussian_log_likelihood(self.dataset_in_orig,
                                                                   masked_output_mean, masked_output_logvar)
 
+        # mean over the entries of the batch, or over the channels the trials
+        #  have with zero-padded ('stacked') batches
+        channels_bxtxc = this_dataset_dims_bxtxc[:, hps.ic_enc_seg_len:, :]
+        if session_params == 'stacked':
+            rec_mean = lambda x: tf.reduce_sum(x) / tf.reduce_sum(channels_bxtxc)
+        else:
+            rec_mean = tf.reduce_mean
+
         # costs for held-in samples
         self.rec_cost_heldin = - (1. / self.cv_keep_ratio) * \
-                              tf.reduce_mean(self.loglikelihood_b_t * self.cv_binary_mask_batch)
+                              rec_mean(self.loglikelihood_b_t * self.cv_binary_mask_batch)
 
         # cost for held-out samples
         if hps.cv_keep_ratio < 1.0:
             self.rec_cost_heldout = - (1. / (1. - self.cv_keep_ratio)) * \
-                                  tf.reduce_mean(self.loglikelihood_b_t * (1. - self.cv_binary_mask_batch))
+                                  rec_mean(self.loglikelihood_b_t * (1. - self.cv_binary_mask_batch) * channels_bxtxc)
         else:
             self.rec_cost_heldout = tf.constant(np.nan)
 
@@ -719,6 +945,9 @@ class LFADS(object):
             if l2_scale == 0:
                 continue
             l2_reg_vars = tf.get_collection(l2_reg)
+            # a reused build (see build_step) adds the same variables again
+            l2_reg_vars = [v for i, v in enumerate(l2_reg_vars)
+                           if v.name not in [u.name for u in l2_reg_vars[:i]]]
 
             for v in l2_reg_vars:
                 numel = tf.reduce_prod(tf.concat(axis=0, values=tf.shape(v)))
@@ -754,60 +983,365 @@ class LFADS(object):
                                                 tf.clip_by_global_norm(
                                                     self.gradients, \
                                                     hps['max_grad_norm'])
-        # this is the optimizer
-        #self.opt = tf.train.AdamOptimizer(self.learning_rate)
-        self.opt = tf.train.AdamOptimizer(self.learning_rate, beta1=hps['beta1'], beta2=hps['beta2'], epsilon=hps['adam_epsilon'])
-        #, beta1=0.9, beta2=0.999, epsilon=1e-01)
+        if hps.get('lazy_session_adam', False):
+            # a step only updates the read-in/read-out parameters of its sessions.
+            #  stacked ones get the gathered rows as sparse gradients, per-session
+            #  ones (session_params 'case') get all rows or none
+            for i, var in enumerate(self.trainable_vars):
+                if var.name in session_var_preds:
+                    rows = tf.range(tf.where(session_var_preds[var.name], tf.shape(var)[0], 0))
+                    self.gradients[i] = tf.IndexedSlices(tf.gather(self.gradients[i], rows), rows,
+                                                         tf.shape(var))
+
+    def accumulate_costs(self, step):
+        """Add the costs of a step (this model, or a copy of it built by
+        build_fused_train_op), weighted by its batch size, to the cost sums."""
+        batch_weight = tf.cast(tf.shape(step.dataset_ph)[0], tf.float64)
+        costs = tf.cast(tf.stack([step.total_cost, step.rec_cost_heldin, step.rec_cost_heldout,
+                                  step.kl_cost, step.l2_cost, step.grad_global_norm]), tf.float64)
+        return tf.group(self.cost_sums.assign_add(batch_weight * costs),
+                        self.cost_weight.assign_add(batch_weight))
+
+    def build_fused_train_op(self, hps, datasets, dropout_keep_prob):
+        """Several training steps in one session.run, for input_mode 'device'.
+
+        A tf.while_loop takes one step per row of fused_idxs_ph: the first
+        fused_batch_sizes_ph[k] trial indices of the row pick the batch from
+        the train data of dataset fused_names_ph[k]. Each step gathers its
+        batch on the device, builds the model on it (build_step, reusing the
+        variables), adds its costs to the cost sums and applies its gradients
+        with self.opt before the next step starts, so K fused steps train the
+        same as K train_op steps on the same batches (see run_epoch).
+        """
+        with tf.variable_scope('placeholders'):
+            self.fused_names_ph = tf.placeholder(tf.string, [None], name='fused_dataset_names')
+            self.fused_idxs_ph = tf.placeholder(tf.int32, [None, None], name='fused_trial_idxs')
+            self.fused_batch_sizes_ph = tf.placeholder(tf.int32, [None], name='fused_batch_sizes')
+
+        def train_step(k):
+            step = copy.copy(self)
+            step.dataName = self.fused_names_ph[k]
+            idxs = self.fused_idxs_ph[k, :self.fused_batch_sizes_ph[k]]
+            step.dataset_ph, step.cv_rand_mask_ph, step.ext_input_ph = \
+                self.gather_device_batch(step.dataName, 'train', idxs)
+            step.dataset_float = tf.cast(step.dataset_ph, tf.float32)
+            if self.session_idx is not None:
+                name_idx = tf.argmax(tf.cast(tf.equal(tf.constant(hps.dataset_names), step.dataName), tf.int32),
+                                     output_type=tf.int32)
+                step.session_idx = tf.fill(tf.shape(step.dataset_ph)[:1], name_idx)
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                step.build_step(hps, datasets, dropout_keep_prob, reuse=True)
+            with tf.control_dependencies([self.accumulate_costs(step)]):
+                apply_op = self.opt.apply_gradients(zip(step.gradients, step.trainable_vars),
+                                                    global_step=self.train_step)
+            with tf.control_dependencies([apply_op]):
+                return k + 1
+
+        num_fused = tf.shape(self.fused_names_ph)[0]
+        # one step at a time: each one reads the variables the last one updated
+        return tf.while_loop(lambda k: k < num_fused, train_step, [tf.constant(0)],
+                             parallel_iterations=1, name='fused_train_steps')
+
+
+    def build_stacked_session_params(self, hps, datasets):
+      """Read-in and read-out parameters of all sessions, stacked by session index.
+
+      With hps.session_params 'stacked', each read-in/read-out matrix and bias
+      is a single variable with a leading sessions dimension, zero-padded to
+      the most channels of any session (self.max_data_dim). Each trial gathers
+      its session's parameters by self.session_idx, so a batch can mix trials
+      of several sessions and the graph does not grow with their number.
+      Sessions with alignment matrices/biases are initialized from them as
+      with the per-session variables ('case'), the others at random.
 
-        # global that holds current step number
-        self.train_step = tf.get_variable("global_step", [], tf.int64,
-                                     tf.zeros_initializer(),
-                                     trainable=False)
-        self.train_op = self.opt.apply_gradients(
-            zip(self.gradients, self.trainable_vars), global_step = self.train_step)
+      Returns:
+        The read-in W (batch x max_data_dim x in_factors_dim) and b (batch x 1
+        x in_factors_dim), both None if hps.in_factors_dim is 0, the read-out W
+        (batch x factors_dim x output size) and b (batch x 1 x output size),
+        and the mask of the channels of each trial (batch x time x
+        max_data_dim). Gaussian outputs are the means and then the
+        log-variances, each max_data_dim wide.
+      """
+      names = hps.dataset_names
+      nsessions = len(names)
+      data_dims = np.array([hps.dataset_dims[name] for name in names])
+      self.max_data_dim = max_dim = int(data_dims.max())
+      channel_mask_sxc = (np.arange(max_dim) < data_dims[:, None]).astype(np.float32)
+      noutputs = 1 if hps.output_dist.lower() == 'poisson' else 2
+      alignments = [_alignment_init_values(datasets[name], hps.dataset_dims[name], hps.in_factors_dim)
+                    if hps.in_factors_dim > 0 else (None, None) for name in names]
+
+      def stacked_variable(name, init_value, has_init, stddev, mask):
+          # random normal (stddev per session) for sessions without an init value
+          random_init = tf.random_normal(init_value.shape) * (stddev[:, None, None] * mask).astype(np.float32)
+          initial_value = tf.where(tf.constant(has_init), tf.constant(init_value), random_init)
+          return tf.get_variable(name, initializer=initial_value,
+                                 collections=[tf.GraphKeys.GLOBAL_VARIABLES, "norm-variables"])
+
+      in_fac_W = in_fac_b = None
+      if hps.in_factors_dim > 0:
+          in_W = np.zeros([nsessions, max_dim, hps.in_factors_dim], np.float32)
+          in_b = np.zeros([nsessions, 1, hps.in_factors_dim], np.float32)
+          for s, (in_mat_cxf, align_bias_1xc) in enumerate(alignments):
+              if in_mat_cxf is not None:
+                  in_W[s, :data_dims[s]] = in_mat_cxf
+                  if align_bias_1xc is not None:
+                      # see the per-session read-in
+                      in_b[s] = -np.dot(align_bias_1xc, in_mat_cxf)
+          in_W_var = stacked_variable('stacked_in_fac_linear/W', in_W,
+                                      np.array([m is not None for m, _ in alignments]),
+                                      1.0 / np.sqrt(data_dims), channel_mask_sxc[:, :, None])
+          in_b_var = tf.get_variable('stacked_in_fac_linear/b', initializer=tf.constant(in_b))
+          in_fac_W = tf.gather(in_W_var, self.session_idx)
+          in_fac_b = tf.gather(in_b_var, self.session_idx)
+
+      out_W = np.zeros([nsessions, hps.factors_dim, noutputs * max_dim], np.float32)
+      out_b = np.zeros([nsessions, 1, noutputs * max_dim], np.float32)
+      has_out_W = np.zeros(nsessions, bool)
+      for s, (in_mat_cxf, align_bias_1xc) in enumerate(alignments):
+          for k in range(noutputs):
+              channels = slice(k * max_dim, k * max_dim + data_dims[s])
+              # if input and output factors dims match, initialize with the transposed read-in
+              if in_mat_cxf is not None and hps.in_factors_dim == hps.factors_dim:
+                  out_W[s, :, channels] = in_mat_cxf.T
+                  has_out_W[s] = True
+              if align_bias_1xc is not None:
+                  out_b[s, :, channels] = align_bias_1xc
+      out_W_var = stacked_variable('stacked_out_fac_linear/W', out_W, has_out_W,
+                                   np.full(nsessions, 1.0 / np.sqrt(hps.factors_dim)),
+                                   np.tile(channel_mask_sxc, [1, noutputs])[:, None, :])
+      out_b_var = tf.get_variable('stacked_out_fac_linear/b', initializer=tf.constant(out_b))
+      out_fac_W = tf.gather(out_W_var, self.session_idx)
+      out_fac_b = tf.gather(out_b_var, self.session_idx)
+
+      channel_mask_bxc = tf.gather(tf.constant(channel_mask_sxc), self.session_idx)
+      dims_bxtxc = tf.tile(tf.expand_dims(channel_mask_bxc, 1), [1, hps['num_steps'], 1])
+      return in_fac_W, in_fac_b, out_fac_W, out_fac_b, dims_bxtxc
 
-        # hooks to save down model checkpoints:
-        # "save every so often" (i.e., recent checkpoints)
-        self.seso_saver = tf.train.Saver(tf.global_variables(),
-                                     max_to_keep=hps.max_ckpt_to_keep)
+    ## functions to interface with the outside world
+    def build_input_pipeline(self, hps, input_dtype):
+      """Build the tf.data pipeline that feeds run_epoch in input_mode 'tf_data'.
 
-        # lowest validation error checkpoint
-        self.lve_saver = tf.train.Saver(tf.global_variables(),
-                                    max_to_keep=hps.max_ckpt_to_keep)
-        
-        # store the hps
-        self.hps = hps
+      Each element is the batch (dataset name, data, cv mask, ext input) for
+      one step of the epoch set up by start_input_epoch. The batches are
+      gathered from the numpy datasets by a parallel map and prefetched, so
+      they are ready before the step that needs them.
 
+      Returns:
+        An initializable iterator (see start_input_epoch).
+      """
+      num_steps = hps['num_steps']
+      ext_input_dim = hps['ext_input_dim']
+      data_np_dtype = input_dtype.as_numpy_dtype
+
+      def gather_batch(i):
+          datasets, kind, pairs = self._input_epoch
+          name, example_idxs = pairs[i]
+          data_dict = datasets[name]
+          data_bxtxd = np.asarray(data_dict[kind + '_data'][example_idxs], dtype=data_np_dtype)
+          cv_rand_mask = data_dict[kind + '_data_cvmask']
+          if cv_rand_mask is None:
+              cvmask_bxtxd = np.ones(data_bxtxd.shape, dtype=np.float32)
+          else:
+              cvmask_bxtxd = np.asarray(cv_rand_mask[example_idxs], dtype=np.float32)
+          ext_input = data_dict.get(kind + '_ext_input')
+          if ext_input is None:
+              ext_input_bxtxi = np.zeros((len(example_idxs), num_steps, ext_input_dim), dtype=np.float32)
+          else:
+              ext_input_bxtxi = np.asarray(ext_input[example_idxs], dtype=np.float32)
+          return np.array(name.encode()), data_bxtxd, cvmask_bxtxd, ext_input_bxtxi
+
+      def gather_batch_op(i):
+          name, data, mask, ext_input = tf.numpy_function(
+              gather_batch, [i], [tf.string, input_dtype, tf.float32, tf.float32])
+          name.set_shape([])
+          data.set_shape([None, num_steps, None])
+          mask.set_shape([None, num_steps, None])
+          ext_input.set_shape([None, num_steps, ext_input_dim])
+          return name, data, mask, ext_input
+
+      self._input_epoch = None
+      self.input_num_batches = tf.placeholder(tf.int64, shape=(), name='input_num_batches')
+      dataset = tf.data.Dataset.range(self.input_num_batches)
+      dataset = dataset.map(gather_batch_op, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+      return tf.data.make_initializable_iterator(dataset)
+
+    def start_input_epoch(self, datasets, kind, all_name_example_idx_pairs):
+      """Point the tf.data pipeline at these batches, in this order.
 
-        # Don't print this?
-        '''
-        print("Model Variables (to be optimized): ")
-        total_params = 0
-        tvars = self.trainable_vars
-        for i in range(len(tvars)):
-            shape = tvars[i].get_shape().as_list()
-            print("- ", i, tvars[i].name, shape)
-            total_params += np.prod(shape)
-        print("Total model parameters: ", total_params)
-        '''
-        
-        self.merged_generic = tf.summary.merge_all() # default key is 'summaries'
-        session = tf.get_default_session()
-        self.logfile = os.path.join(hps.lfads_save_dir, "lfads_log")
-        self.writer = tf.summary.FileWriter(self.logfile, session.graph)
+      Args:
+        datasets: The dataset dict the batches index into.
+        kind: 'train' or 'valid'
+        all_name_example_idx_pairs: The (name, indices) pairs, as returned by
+          shuffle_and_flatten_datasets.
+      """
+      self._input_epoch = (datasets, kind, all_name_example_idx_pairs)
+      session = tf.get_default_session()
+      session.run(self.input_iterator.initializer,
+                  feed_dict={self.input_num_batches: len(all_name_example_idx_pairs)})
+
+    def build_device_datasets(self, hps, datasets, input_dtype):
+      """Keep the datasets on the device, for input_mode 'device'.
+
+      Each dataset's train/valid data, cv mask and ext input go into
+      non-trainable variables, which are left out of the global variables (so
+      they are neither initialized with the model nor checkpointed) and are
+      filled once by upload_device_datasets. run_epoch then only feeds the
+      dataset name, the kind ('train' or 'valid') and the trial indices of the
+      batch, and the batch is gathered in the graph.
+      With hps.session_params 'stacked', the trials of all datasets go into
+      one set of variables per kind instead, zero-padded to the most
+      channels, so that the graph does not grow with the number of datasets.
+
+      Returns:
+        The gathered data, cv mask and ext input (None without ext inputs)
+        of the batch. self.gather_device_batch(data_name, kind, idxs) gathers
+        them for other trials.
+      """
+      num_steps = hps['num_steps']
+      ext_input_dim = hps['ext_input_dim']
+      self.input_idxs_ph = tf.placeholder(tf.int32, [None], name='input_trial_idxs')
+      self.input_kind_ph = tf.placeholder(tf.string, shape=(), name='input_kind')
+      self.device_datasets = datasets
+      # (variable initializer, value placeholder, numpy value) for the upload,
+      # cleared once upload_device_datasets has run
+      self._device_uploads = []
+
+      def device_variable(value, dtype, name):
+          value_ph = tf.placeholder(dtype, value.shape, name=name + '_value')
+          var = tf.Variable(value_ph, trainable=False, collections=[], name=name)
+          self._device_uploads.append((var.initializer, value_ph, value))
+          return var
+
+      def gather_fn(var, idxs, dtype=tf.float32):
+          return lambda: tf.cast(tf.gather(var, idxs), dtype)
+
+      def fill_fn(idxs, value, dim):
+          return lambda: tf.fill([tf.size(idxs), num_steps, dim], value)
+
+      # (kind, dataset name (None if stacked), data variable, cv mask variable,
+      #  ext input variable, number of channels, trial offsets (if stacked))
+      device_vars = []
+      stacked = hps.get('session_params', 'case') == 'stacked'
+      if stacked:
+          names = hps.dataset_names
+          max_dim = max(hps.dataset_dims[name] for name in names)
+          for kind in ['train', 'valid']:
+              kind_data = [datasets[name].get(kind + '_data') for name in names]
+              num_trials = [0 if data is None else len(data) for data in kind_data]
+              if sum(num_trials) == 0:
+                  continue
+              # the trials of dataset d start at offsets[d]
+              offsets = np.cumsum([0] + num_trials[:-1]).astype(np.int32)
+              data_extxd = np.zeros((sum(num_trials), num_steps, max_dim), input_dtype.as_numpy_dtype)
+              cvmask_extxd = np.ones(data_extxd.shape, np.uint8)
+              ext_input_extxi = np.zeros((sum(num_trials), num_steps, ext_input_dim), np.float32)
+              for name, offset, n, data in zip(names, offsets, num_trials, kind_data):
+                  if n == 0:
+                      continue
+                  trials = slice(offset, offset + n)
+                  data_extxd[trials, :, :data.shape[2]] = np.asarray(data)
+                  if datasets[name].get(kind + '_data_cvmask') is not None:
+                      cvmask_extxd[trials, :, :data.shape[2]] = datasets[name][kind + '_data_cvmask']
+                  if ext_input_dim > 0 and datasets[name].get(kind + '_ext_input') is not None:
+                      ext_input_extxi[trials] = datasets[name][kind + '_ext_input']
+              var_name = 'device_%s' % kind
+              data_var = device_variable(data_extxd, input_dtype, var_name + '_data')
+              mask_var = device_variable(cvmask_extxd, tf.uint8, var_name + '_cvmask')
+              ext_var = device_variable(ext_input_extxi, tf.float32, var_name + '_ext_input') \
+                  if ext_input_dim > 0 else None
+              device_vars.append((kind, None, data_var, mask_var, ext_var, max_dim, offsets))
+      else:
+          for d, (name, data_dict) in enumerate(datasets.items()):
+              for kind in ['train', 'valid']:
+                  data_extxd = data_dict.get(kind + '_data')
+                  if data_extxd is None or len(data_extxd) == 0:
+                      continue
+                  var_name = 'device_%s_%d' % (kind, d)
+                  data_var = device_variable(np.asarray(data_extxd, dtype=input_dtype.as_numpy_dtype),
+                                             input_dtype, var_name + '_data')
+                  mask_var = ext_var = None
+                  cv_rand_mask = data_dict.get(kind + '_data_cvmask')
+                  if cv_rand_mask is not None:
+                      # the 0/1 mask is stored as uint8 and cast after the gather
+                      mask_var = device_variable(np.asarray(cv_rand_mask, dtype=np.uint8),
+                                                 tf.uint8, var_name + '_cvmask')
+                  ext_input = data_dict.get(kind + '_ext_input')
+                  if ext_input_dim > 0 and ext_input is not None:
+                      ext_var = device_variable(np.asarray(ext_input, dtype=np.float32),
+                                                tf.float32, var_name + '_ext_input')
+                  device_vars.append((kind, name, data_var, mask_var, ext_var, data_extxd.shape[2], None))
+
+      def gather_batch(data_name, kind, idxs):
+          # the trials idxs of data_name's kind ('train' or 'valid') data
+          data_pairs, mask_pairs, ext_pairs = [], [], []
+          if stacked:
+              name_idx = tf.argmax(tf.cast(tf.equal(tf.constant(names), data_name), tf.int32),
+                                   output_type=tf.int32)
+          for var_kind, name, data_var, mask_var, ext_var, data_dim, offsets in device_vars:
+              if stacked:
+                  var_idxs = tf.gather(tf.constant(offsets), name_idx) + idxs
+                  pred = tf.equal(kind, var_kind)
+              else:
+                  var_idxs = idxs
+                  pred = tf.logical_and(tf.equal(data_name, name), tf.equal(kind, var_kind))
+              data_pairs.append((pred, gather_fn(data_var, var_idxs, input_dtype)))
+              if mask_var is None:
+                  mask_pairs.append((pred, fill_fn(idxs, 1.0, data_dim)))
+              else:
+                  mask_pairs.append((pred, gather_fn(mask_var, var_idxs)))
+              if ext_input_dim > 0:
+                  if ext_var is None:
+                      ext_pairs.append((pred, fill_fn(idxs, 0.0, ext_input_dim)))
+                  else:
+                      ext_pairs.append((pred, gather_fn(ext_var, var_idxs)))
+          input_data = _case_with_no_default(data_pairs)
+          input_mask = _case_with_no_default(mask_pairs)
+          input_ext = _case_with_no_default(ext_pairs) if ext_input_dim > 0 else None
+          return input_data, input_mask, input_ext
+
+      # also gathers the batches of build_fused_train_op
+      self.gather_device_batch = gather_batch
+      return gather_batch(self.dataName, self.input_kind_ph, self.input_idxs_ph)
+
+    def upload_device_datasets(self):
+      """Copy the datasets into their device variables (input_mode 'device').
+
+      This runs once, from __init__. The numpy values (including the
+      zero-padded stacked arrays) are dropped afterwards, so the host does
+      not keep a second copy of the data.
+      """
+      session = tf.get_default_session()
+      for initializer, value_ph, value in self._device_uploads:
+          session.run(initializer, feed_dict={value_ph: value})
+      self._device_uploads = None
+
+    def uses_device_datasets(self, datasets, kind='train'):
+      """True if these are the datasets that were uploaded to the device."""
+      if self.device_datasets is None:
+          return False
+      return all(name in self.device_datasets and
+                 data_dict[kind + '_data'] is self.device_datasets[name][kind + '_data']
+                 for name, data_dict in datasets.items())
 
-        
-    ## functions to interface with the outside world
     def build_feed_dict(self, train_name, data_bxtxd, cv_rand_mask=None, ext_input_bxtxi=None, run_type=None,
                         keep_prob=None, kl_ic_weight=1.0, kl_co_weight=1.0,
-                        keep_ratio=None, cv_keep_ratio=None, kl_weight=1.0, l2_weight=1.0):
+                        keep_ratio=None, cv_keep_ratio=None, kl_weight=1.0, l2_weight=1.0,
+                        session_idxs=None):
       """Build the feed dictionary, handles cases where there is no value defined.
 
       Args:
         train_name: The key into the datasets, to set the tf.case statement for
           the proper readin / readout matrices.
-        data_bxtxd: The data tensor
+        data_bxtxd: The data tensor, or a tf.SparseTensorValue (see
+          SparseSpikeData.coo_batch)
+        (data_bxtxd may be None in input_mode 'tf_data' or 'device', then the
+        batch comes from the input pipeline / the device datasets, and so may
+        train_name in input_mode 'tf_data')
         keep_prob: The drop out keep probability.
+        session_idxs (optional): The session index of each trial, for batches
+          that mix sessions (see mixed_session_batch), instead of train_name.
 
       Returns:
         The feed dictionary with TF tensors as keys and data as values, for use
@@ -824,9 +1358,22 @@ class LFADS(object):
       #   self.keep_prob
 
       feed_dict = {}
-      B, T, _ = data_bxtxd.shape
-      feed_dict[self.dataName] = train_name
-      feed_dict[self.dataset_ph] = data_bxtxd
+      if train_name is not None:
+          feed_dict[self.dataName] = train_name
+      if session_idxs is not None:
+          feed_dict[self.session_idx] = session_idxs
+      if isinstance(data_bxtxd, tf.SparseTensorValue) and self.inputs_from_graph:
+          # the pipeline's data replaces the densify, so make the batch dense here
+          dense_bxtxd = np.zeros(data_bxtxd.dense_shape, dtype=data_bxtxd.values.dtype)
+          dense_bxtxd[tuple(data_bxtxd.indices.T)] = data_bxtxd.values
+          data_bxtxd = dense_bxtxd
+      if isinstance(data_bxtxd, tf.SparseTensorValue):
+          # fed by component, so that run_step's callables can take them
+          feed_dict[self.dataset_sparse_ph.indices] = data_bxtxd.indices
+          feed_dict[self.dataset_sparse_ph.values] = cast_count_data(data_bxtxd.values, self.input_data_dtype)
+          feed_dict[self.dataset_sparse_ph.dense_shape] = data_bxtxd.dense_shape
+      elif data_bxtxd is not None:
+          feed_dict[self.dataset_ph] = cast_count_data(data_bxtxd, self.input_data_dtype)
       feed_dict[self.kl_ic_weight] = kl_ic_weight
       feed_dict[self.kl_co_weight] = kl_co_weight
       feed_dict[self.kl_weight] = kl_weight
@@ -835,20 +1382,28 @@ class LFADS(object):
       if ext_input_bxtxi is not None and self.ext_input_ph is not None:
           feed_dict[self.ext_input_ph] = ext_input_bxtxi
 
-      if cv_rand_mask is None:
-          feed_dict[self.cv_rand_mask_ph] = np.ones_like(data_bxtxd)
-      else:
+      # if no mask is given, the graph defaults to all ones
+      if cv_rand_mask is not None:
           feed_dict[self.cv_rand_mask_ph] = cv_rand_mask
+      elif data_bxtxd is not None and self.inputs_from_graph:
+          # (with the tf.data pipeline or device datasets the default is their mask)
+          feed_dict[self.cv_rand_mask_ph] = np.ones(data_bxtxd.shape, dtype=np.float32)
 
       if run_type is None:
-        feed_dict[self.run_type] = self.hps.kind
-      else:
-        feed_dict[self.run_type] = run_type
+        run_type = self.hps.kind
+      if self.graph_samples_posterior is not None and \
+         run_type_samples_posterior(run_type) != self.graph_samples_posterior:
+        raise ValueError("The graph was built for run type '%s' and can't run '%s' "
+                         "(build it with hps.specialize_run_type False)."
+                         % (self.graph_run_type, kind_dict_key(run_type)))
+      feed_dict[self.run_type] = run_type
 
       if keep_prob is None:
-        feed_dict[self.keep_prob] = self.hps.keep_prob
-      else:
-        feed_dict[self.keep_prob] = keep_prob
+        keep_prob = self.hps.keep_prob
+      if self.graph_run_type not in [None, 'train'] and keep_prob != 1.0:
+        raise ValueError("The graph was built for run type '%s', which has no dropout."
+                         % self.graph_run_type)
+      feed_dict[self.keep_prob] = keep_prob
 
       if keep_ratio is None:
         feed_dict[self.keep_ratio] = self.hps.keep_ratio
@@ -862,13 +1417,60 @@ class LFADS(object):
 
       return feed_dict
 
-    def get_num_steps_per_epoch(self, datasets, kind='train'):
-        # easy, not so efficient way of getting the number of steps per epoch for all datasets
-        tmp = self.shuffle_and_flatten_datasets(datasets, kind)
-        return len(tmp)
+    def run_step(self, fetches_name, fetches, feed_dict):
+      """Same as session.run(fetches, feed_dict), through a Session.make_callable.
 
+      A callable is made the first time for each fetches_name ('train',
+      'valid', 'posterior', ...) and set of fed tensors, and after that it is
+      called with just the feed values, in order. This skips the parsing of
+      fetches and feeds that session.run does on every call. Set
+      hps.use_step_callables to False to use session.run instead.
+      """
+      session = tf.get_default_session()
+      if not self.hps.get('use_step_callables', True):
+          return session.run(fetches, feed_dict=feed_dict)
+      if session is not self._step_fns_session:
+          self._step_fns = {}
+          self._step_fns_session = session
+      key = (fetches_name, tuple(feed_dict))
+      step_fn = self._step_fns.get(key)
+      if step_fn is None:
+          step_fn = session.make_callable(fetches, feed_list=list(key[1]))
+          self._step_fns[key] = step_fn
+      return step_fn(*feed_dict.values())
 
-    def shuffle_and_flatten_datasets(self, datasets, kind='train'):
+    def get_num_steps_per_epoch(self, datasets, kind='train'):
+        # computed from the trial counts, no batches are drawn
+        return self.get_epoch_planner(datasets, kind).num_steps
+
+    def get_epoch_planner(self, datasets, kind='train'):
+      """The EpochPlanner of this kind ('train' or 'valid') for these datasets.
+
+      One planner is made per kind and set of trial counts. Their seed is
+      hps.batch_seed, or one drawn from numpy's global random state when the
+      model is built if that is -1.
+      With out-of-core (lazily loaded) data and hps.shuffle_buffer_trials > 0,
+      training batches of the out-of-core datasets are block-shuffled (see
+      ListOfBlockShuffledBatches), so that run_epoch can read ahead on disk.
+      """
+      kind_data = kind + '_data'
+      num_trials = [(name, data_dict[kind_data].shape[0]) for name, data_dict in datasets.items()]
+      key = (kind, tuple(num_trials))
+      if key not in self._epoch_planners:
+          block_sizes = {}
+          if kind == 'train' and self.use_out_of_core_batches(datasets, kind):
+              for name, data_dict in datasets.items():
+                  if is_out_of_core(data_dict[kind_data]):
+                      block_sizes[name] = self.hps.get('shuffle_block_trials', 0) or \
+                          shuffle_block_size(data_dict[kind_data], self.hps.batch_size)
+          batch_size = self.hps.batch_size if kind == 'train' else self.hps.valid_batch_size
+          self._epoch_planners[key] = EpochPlanner(num_trials, batch_size, shuffle=kind == 'train',
+                                                   seed=self.batch_seed, block_sizes=block_sizes,
+                                                   buffer_size=self.hps.get('shuffle_buffer_trials', 0),
+                                                   mix_datasets=self.hps.get('mix_session_batches', False))
+      return self._epoch_planners[key]
+
+    def shuffle_and_flatten_datasets(self, datasets, kind='train', epoch=None, start_step=0):
       """Since LFADS supports multiple datasets in the same dynamical model,
       we have to be careful to use all the data in a single training epoch.  But
       since the datasets my have different data dimensionality, we cannot batch
@@ -881,57 +1483,129 @@ class LFADS(object):
         datasets: A dict of data dicts.  The dataset dict is simply a
           name(string)-> data dictionary mapping (See top of lfads.py).
         kind: 'train' or 'valid'
+        epoch, start_step (optional): Which plan, and from which step (see
+          EpochPlanner.plan). By default the next plan, in full.
 
       Returns:
         A flat list, in which each element is a pair ('name', indices).
       """
-      batch_size = self.hps.batch_size
-      ndatasets = len(datasets)
-      random_example_idxs = {}
-      epoch_idxs = {}
-      all_name_example_idx_pairs = []
-      kind_data = kind + '_data'
-      for name, data_dict in datasets.items():
-        nexamples, ntime, data_dim = data_dict[kind_data].shape
-        epoch_idxs[name] = 0
-        if kind == 'valid':
-            n = self.hps.valid_batch_size
-            l = range(nexamples)
-            random_example_idxs = [list(l[i:i+n]) for i in range(0, len(l), n)]
-        else:
-            random_example_idxs = \
-                ListOfRandomBatches(nexamples, batch_size)
-
-        epoch_size = len(random_example_idxs)
-        names = [name] * epoch_size
-        all_name_example_idx_pairs += zip(names, random_example_idxs)
+      planner = self.get_epoch_planner(datasets, kind)
+      return list(planner.plan(epoch, start_step))
 
-      # shuffle the batches so the dataset order is scrambled
-      np.random.shuffle(all_name_example_idx_pairs) #( shuffle in place)
-
-      return all_name_example_idx_pairs
+    def mixed_session_batch(self, datasets, kind, names, example_idxs):
+      """Gather a batch of trials of several datasets (hps.mix_session_batches).
 
+      Args:
+        names, example_idxs: The dataset name and trial index of each trial,
+          as planned by EpochPlanner with mix_datasets.
 
-    def train_epoch(self, datasets, do_save_ckpt, kl_ic_weight, kl_co_weight, kl_weight, l2_weight):
+      Returns:
+        The data and cv masks, zero-padded to self.max_data_dim channels, the
+        ext inputs (None without) and the session index of each trial.
+      """
+      session_idxs = np.zeros(len(names), np.int32)
+      data_bxtxd = cv_mask_bxtxd = ext_input_bxtxi = None
+      for name in np.unique(names):
+          rows = np.flatnonzero(names == name)
+          idxs = example_idxs[rows]
+          data_dict = datasets[name]
+          data = np.asarray(data_dict[kind + '_data'][idxs])
+          if data_bxtxd is None:
+              data_bxtxd = np.zeros((len(names), data.shape[1], self.max_data_dim), data.dtype)
+              cv_mask_bxtxd = np.ones(data_bxtxd.shape, np.float32)
+          data_bxtxd[rows, :, :data.shape[2]] = data
+          if data_dict[kind + '_data_cvmask'] is not None:
+              cv_mask_bxtxd[rows, :, :data.shape[2]] = data_dict[kind + '_data_cvmask'][idxs]
+          if data_dict[kind + '_ext_input'] is not None:
+              ext_input = data_dict[kind + '_ext_input'][idxs]
+              if ext_input_bxtxi is None:
+                  ext_input_bxtxi = np.zeros((len(names),) + ext_input.shape[1:], np.float32)
+              ext_input_bxtxi[rows] = ext_input
+          session_idxs[rows] = self.hps.dataset_names.index(name)
+      return data_bxtxd, cv_mask_bxtxd, ext_input_bxtxi, session_idxs
+
+    def use_out_of_core_batches(self, datasets, kind='train'):
+      """True if batches of this kind are block-shuffled and read ahead."""
+      return self.hps.get('shuffle_buffer_trials', 0) > 0 and not self.hps.get('mix_session_batches', False) and \
+          any(is_out_of_core(data_dict[kind + '_data']) for data_dict in datasets.values())
+
+
+    def train_epoch(self, datasets, do_save_ckpt, kl_ic_weight, kl_co_weight, kl_weight, l2_weight,
+                    start_step=0, cost_sums=None):
     # train_epoch runs the entire training set once
     #    (it is mostly a wrapper around "run_epoch")
     # afterwards it saves a checkpoint if requested
+    # start_step and cost_sums resume an interrupted epoch (see run_epoch)
         collected_op_values = self.run_epoch(datasets, kl_ic_weight,
                                              kl_co_weight, dataset_type="train",
                                              run_type = "train",
                                              kl_weight=kl_weight,
-                                             l2_weight=l2_weight)
+                                             l2_weight=l2_weight,
+                                             start_step=start_step,
+                                             cost_sums=cost_sums)
 
         if do_save_ckpt:
-          session = tf.get_default_session()
-          checkpoint_path = os.path.join(self.hps.lfads_save_dir,
-                                         self.hps.checkpoint_name + '.ckpt')
-          self.seso_saver.save(session, checkpoint_path,
-                               global_step=self.train_step)
+          self.save_checkpoint()
 
         return collected_op_values
 
 
+    def save_checkpoint(self, trainer_state=None):
+    # save a (non-lve) checkpoint, and the trainer state to resume from it if given
+        session = tf.get_default_session()
+        checkpoint_path = os.path.join(self.hps.lfads_save_dir,
+                                       self.hps.checkpoint_name + '.ckpt')
+        self.seso_saver.save(session, checkpoint_path,
+                             global_step=self.train_step)
+        if trainer_state is not None:
+            self.save_trainer_state(trainer_state)
+
+
+    def trainer_state_path(self, train_step):
+        return os.path.join(self.hps.lfads_save_dir,
+                            '%s_trainer_state-%d.json' % (self.hps.checkpoint_name, train_step))
+
+
+    def save_trainer_state(self, trainer_state):
+      """Write the state of train_model next to the checkpoint of its step.
+
+      The state (see train_model) is what it takes to continue training from
+      that checkpoint as if it had not stopped. It is only written for the
+      (non-lve) checkpoints that are kept, and deleted with them.
+      """
+      ckpt = tf.train.get_checkpoint_state(self.hps.lfads_save_dir)
+      kept_paths = ckpt.all_model_checkpoint_paths if ckpt else []
+      kept_steps = set(int(re.search('-([0-9]+)$', path).group(1)) for path in kept_paths)
+      if trainer_state['train_step'] in kept_steps:
+          fname = self.trainer_state_path(trainer_state['train_step'])
+          # written whole or not at all, in case the job is stopped meanwhile
+          with open(fname + '.tmp', 'w') as f:
+              json.dump(trainer_state, f)
+          os.replace(fname + '.tmp', fname)
+      state_re = re.escape(self.hps.checkpoint_name) + r'_trainer_state-([0-9]+)\.json$'
+      for fname in os.listdir(self.hps.lfads_save_dir):
+          match = re.match(state_re, fname)
+          if match and int(match.group(1)) not in kept_steps:
+              os.remove(os.path.join(self.hps.lfads_save_dir, fname))
+
+
+    def load_trainer_state(self, train_step):
+      """The trainer state saved with the checkpoint at train_step, or None.
+
+      None as well if the run that saved it had finished, or if the model was
+      restored from another than the latest (non-lve) checkpoint (see
+      hps.checkpoint_pb_load_name): training then starts over as before.
+      """
+      if self.hps['checkpoint_pb_load_name'] not in ('', 'checkpoint'):
+          return None
+      fname = self.trainer_state_path(train_step)
+      if not os.path.exists(fname):
+          return None
+      with open(fname) as f:
+          trainer_state = json.load(f)
+      return None if trainer_state['finished'] else trainer_state
+
+
     def do_validation(self, datasets, kl_ic_weight, kl_co_weight, dataset_type, kl_weight, l2_weight):
     # do_validation performs an evaluation of the reconstruction cost
     #    can do this on either train or valid datasets
@@ -946,12 +1620,16 @@ class LFADS(object):
 
 
     def run_epoch(self, datasets, kl_ic_weight, kl_co_weight, dataset_type = "train", run_type="train",
-                  kl_weight=1.0, l2_weight=1.0):
-        ops_to_eval = [self.total_cost, self.rec_cost_heldin, self.rec_cost_heldout,
-                       self.kl_cost, self.l2_cost, self.grad_global_norm]
+                  kl_weight=1.0, l2_weight=1.0, start_step=0, cost_sums=None):
+        # steps add their costs to in-graph sums instead of fetching them, the mean
+        #  is read at the end (and every hps.cost_fetch_steps training steps)
+        # to resume an epoch from start_step, cost_sums holds the values of
+        #  (self.cost_sums, self.cost_weight) after the steps before it
+        ops_to_eval = [self.accumulate_costs_op]
         # get a full list of all data for this type (train/valid)
         all_name_example_idx_pairs = \
-          self.shuffle_and_flatten_datasets(datasets, dataset_type)
+          self.shuffle_and_flatten_datasets(datasets, dataset_type, start_step=start_step)
+        num_steps = start_step + len(all_name_example_idx_pairs)
         
         if dataset_type == "train":
             kind_data = "train_data"
@@ -973,41 +1651,148 @@ class LFADS(object):
             
         session = tf.get_default_session()
 
-        evald_ops = []
-        batch_len = []
+        # out-of-core data is read from disk ahead of time, in epoch order
+        read_ahead = {}
+        use_device_datasets = self.uses_device_datasets(datasets, dataset_type)
+        if self.input_iterator is None and not use_device_datasets and \
+           self.use_out_of_core_batches(datasets, dataset_type):
+            for name, data_dict in datasets.items():
+                if is_out_of_core(data_dict[kind_data]):
+                    batches = [idxs for n, idxs in all_name_example_idx_pairs if n == name]
+                    read_ahead[name] = iter(ReadAheadBatches(
+                        [data_dict[kind_data], data_dict[ext_input_kind]], batches,
+                        max(self.hps.shuffle_buffer_trials, self.hps.batch_size)))
+
+        def batch_feed_dicts():
+            # assembles the batches in epoch order, runs ahead of training
+            #  in a background thread (see hps.prefetch_batches)
+            for name, example_idxs in all_name_example_idx_pairs:
+                if not isinstance(name, str):
+                    # a batch of several sessions' trials (hps.mix_session_batches)
+                    this_batch, this_batch_cvmask, ext_input_batch, session_idxs = \
+                        self.mixed_session_batch(datasets, dataset_type, name, example_idxs)
+                    yield self.build_feed_dict(None, this_batch,
+                                               cv_rand_mask=this_batch_cvmask,
+                                               ext_input_bxtxi=ext_input_batch,
+                                               session_idxs=session_idxs,
+                                               **settings)
+                    continue
+                if use_device_datasets:
+                    # the batch is gathered in the graph
+                    feed_dict = self.build_feed_dict(name, None, **settings)
+                    feed_dict[self.input_idxs_ph] = example_idxs
+                    feed_dict[self.input_kind_ph] = dataset_type
+                    yield feed_dict
+                    continue
+                data_dict = datasets[name]
+                data_extxd = data_dict[kind_data]
+                cv_rand_mask = data_dict[cv_mask_name]
+                ext_input_bxtxi = data_dict[ext_input_kind]
+
+                if name in read_ahead:
+                    this_batch, ext_input_batch = next(read_ahead[name])
+                elif isinstance(data_extxd, SparseSpikeData):
+                    # only the batch is densified, on the device
+                    this_batch = data_extxd.coo_batch(example_idxs)
+                else:
+                    this_batch = data_extxd[example_idxs,:,:]
+
+                this_batch_cvmask = cv_rand_mask[example_idxs,:,:] if cv_rand_mask is not None else None
+
+                if name not in read_ahead:
+                    ext_input_batch = ext_input_bxtxi[example_idxs, :, :] if ext_input_bxtxi is not None else None
+
+                yield self.build_feed_dict(name, this_batch,
+                                           cv_rand_mask=this_batch_cvmask,
+                                           ext_input_bxtxi=ext_input_batch,
+                                           **settings)
+
+        settings = dict(keep_prob=keep_prob,
+                        run_type = kind_dict("train"),
+                        kl_ic_weight = kl_ic_weight,
+                        kl_co_weight = kl_co_weight,
+                        keep_ratio=keep_ratio,
+                        kl_weight=kl_weight,
+                        l2_weight=l2_weight,)
+        # device datasets can run several training steps per session.run
+        fused_steps = self.hps.get('fused_train_steps', 0) \
+            if run_type == "train" and use_device_datasets and self.fused_train_op is not None else 0
+
+        def fused_feed_dicts():
+            # runs of up to fused_steps steps, which end at the steps that fetch
+            #  the costs or save a checkpoint. yields the last step of each run
+            chunk = []
+            for step, (name, example_idxs) in enumerate(all_name_example_idx_pairs, start_step):
+                chunk.append((name, example_idxs))
+                if len(chunk) < fused_steps and step + 1 < num_steps and \
+                   not any(n > 0 and (step + 1) % n == 0 for n in [cost_fetch_steps, ckpt_save_steps]):
+                    continue
+                batch_sizes = [len(idxs) for _, idxs in chunk]
+                # one row of trial indices per step, padded to the largest batch
+                idxs_kxb = np.zeros((len(chunk), max(batch_sizes)), np.int32)
+                for k, (_, idxs) in enumerate(chunk):
+                    idxs_kxb[k, :batch_sizes[k]] = idxs
+                feed_dict = self.build_feed_dict(None, None, **settings)
+                feed_dict[self.fused_names_ph] = [name for name, _ in chunk]
+                feed_dict[self.fused_idxs_ph] = idxs_kxb
+                feed_dict[self.fused_batch_sizes_ph] = batch_sizes
+                yield step, feed_dict
+                chunk = []
+
+        if fused_steps > 1:
+            # fused_feed_dicts feeds the batches, see below
+            feed_dicts = None
+        elif self.input_iterator is not None:
+            # the batches come from the tf.data pipeline, only the settings are fed
+            self.start_input_epoch(datasets, dataset_type, all_name_example_idx_pairs)
+            feed_dict = self.build_feed_dict(None, None, **settings)
+            feed_dicts = (feed_dict for _ in all_name_example_idx_pairs)
+        else:
+            feed_dicts = prefetch(batch_feed_dicts(), self.hps.get('prefetch_batches', 0))
+
+        cost_fetch_steps = self.hps.get('cost_fetch_steps', 0) if run_type == "train" else 0
+        # checkpoints within training epochs, only when run by train_model
+        ckpt_save_steps = self.hps.get('ckpt_save_steps', 0) \
+            if run_type == "train" and self._epoch_start_state is not None else 0
+        session.run(self.reset_cost_sums_op)
+        if cost_sums is not None:
+            self.cost_sums.load(cost_sums[0], session)
+            self.cost_weight.load(cost_sums[1], session)
+        fetches_name = run_type
+        if feed_dicts is None:
+            fetches_name, ops_to_eval = 'fused_train', [self.fused_train_op]
+            step_feed_dicts = fused_feed_dicts()
+        else:
+            step_feed_dicts = enumerate(feed_dicts, start_step)
         # iterate over all datasets
-        for name, example_idxs in all_name_example_idx_pairs:
-            data_dict = datasets[name]
-            data_extxd = data_dict[kind_data]
-            cv_rand_mask = data_dict[cv_mask_name]
-            ext_input_bxtxi = data_dict[ext_input_kind]
-            batch_len.append(len(example_idxs))
-
-            this_batch = data_extxd[example_idxs,:,:]
-
-            this_batch_cvmask = cv_rand_mask[example_idxs,:,:] if cv_rand_mask is not None else None
-
-            ext_input_batch = ext_input_bxtxi[example_idxs, :, :] if ext_input_bxtxi is not None else None
-
-            feed_dict = self.build_feed_dict(name, this_batch,
-                                             cv_rand_mask=this_batch_cvmask,
-                                             ext_input_bxtxi=ext_input_batch,
-                                             keep_prob=keep_prob,
-                                             run_type = kind_dict("train"),
-                                             kl_ic_weight = kl_ic_weight,
-                                             kl_co_weight = kl_co_weight,
-                                             keep_ratio=keep_ratio,
-                                             kl_weight=kl_weight,
-                                             l2_weight=l2_weight,)
-            evald_ops_this_batch = session.run(ops_to_eval, feed_dict = feed_dict)
-            # for training runs, there is an extra output argument. kill it
-            if len(evald_ops_this_batch) > 6:
-                tc, rc, rc_v, kl, l2, gn, _= evald_ops_this_batch
-                evald_ops_this_batch = (tc, rc, rc_v, kl, l2, gn)
-            evald_ops.append(evald_ops_this_batch)
-        evald_ops = np.average(evald_ops, axis=0, weights=batch_len) 
-        #print(batch_len)
+        for step, feed_dict in step_feed_dicts:
+            self.run_step(fetches_name, ops_to_eval, feed_dict)
+            if cost_fetch_steps > 0 and (step + 1) % cost_fetch_steps == 0:
+                tc, rc, rc_v, kl, l2, gn = session.run(self.mean_costs)
+                self.printlog("  step %d of %d (TRAIN so far): tot:%.2f, rec:%.2f, kl:%.2f, l2:%.4f" % \
+                              (step + 1, num_steps, tc, rc, kl, l2))
+            if ckpt_save_steps > 0 and (step + 1) % ckpt_save_steps == 0 and step + 1 < num_steps:
+                epoch_cost_sums, epoch_cost_weight, train_step = \
+                    session.run([self.cost_sums, self.cost_weight, self.train_step])
+                self.save_checkpoint(dict(self._epoch_start_state,
+                                          train_step=int(train_step), epoch_step=step + 1,
+                                          epoch_cost_sums=[epoch_cost_sums.tolist(), float(epoch_cost_weight)]))
+        if feed_dicts is not None:
+            feed_dicts.close()
+        evald_ops, train_step = session.run([self.mean_costs, self.train_step])
+        # 'train' and 'valid', or 'train_eval' for validation runs on the training data
+        tag_prefix = dataset_type if run_type == "train" or dataset_type == "valid" else dataset_type + '_eval'
+        self.write_cost_summaries(tag_prefix, evald_ops, train_step)
         return evald_ops
+
+    def write_cost_summaries(self, tag_prefix, costs, train_step):
+        """Publish an epoch's mean costs (as returned by run_epoch) to TensorBoard."""
+        cost_names = ['total_cost', 'rec_cost_heldin', 'rec_cost_heldout',
+                      'kl_cost', 'l2_cost', 'grad_global_norm']
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag_prefix + '/' + name, simple_value=float(cost))
+                                    for name, cost in zip(cost_names, costs)])
+        self.writer.add_summary(summary, train_step)
+        self.writer.flush()
         
 
     def run_learning_rate_decay_opt(self):
@@ -1067,29 +1852,72 @@ class LFADS(object):
 
         valid_costs = []
 
-        kl_weight, l2_weight = self.get_kl_l2_weights(nepoch)
-        # print validation costs before the first training step
-        val_total_cost, valid_set_heldin_samp_cost, valid_set_heldout_samp_cost, val_kl_cost, val_l2_cost ,_= \
-            self.do_validation(datasets,
-                             kl_ic_weight=hps['kl_ic_weight'],
-                             kl_co_weight=hps['kl_co_weight'],
-                             dataset_type="valid",
-                             kl_weight=kl_weight,
-                             l2_weight=l2_weight)
-
-        self.printlog("Epoch:%d, step:%d (TRAIN, VALID): total: None, %.2f\
-        recon: None, %.2f, %.2f,    kl: None, %.2f, kl weight: %.2f" % \
-              (nepoch-1, train_step, val_total_cost,
-               valid_set_heldin_samp_cost, valid_set_heldout_samp_cost, val_kl_cost,
-               kl_weight))
-
-        # pre-load the lve checkpoint (used in case of loaded checkpoint)
-        if target_num_epochs is not None and hps['checkpoint_pb_load_name'] == 'checkpoint_lve':
-            self.lve = valid_set_heldin_samp_cost
+        # smoothed recon costs, initialized after the first epoch
+        smth_train_set_heldin_samp_cost, smth_train_set_heldout_samp_cost = np.nan, np.nan
+        smth_valid_set_heldin_samp_cost, smth_valid_set_heldout_samp_cost = np.nan, np.nan
+
+        def get_trainer_state(finished=False):
+            # everything this loop needs to go on from the current checkpoint
+            #  (see save_trainer_state), taken at the end of each epoch
+            return dict(train_step=int(session.run(self.train_step)),
+                        nepoch=int(nepoch), nepoch_cnt=nepoch_cnt, lve_epoch=int(lve_epoch),
+                        lve=float(self.lve), valid_costs=[float(c) for c in valid_costs],
+                        smoothed_costs=[float(smth_train_set_heldin_samp_cost),
+                                        float(smth_train_set_heldout_samp_cost),
+                                        float(smth_valid_set_heldin_samp_cost),
+                                        float(smth_valid_set_heldout_samp_cost)],
+                        recon_costs=[float(getattr(self, 'trial_recon_cost', np.nan)),
+                                     float(getattr(self, 'samp_recon_cost', np.nan))],
+                        learning_rate=float(self.get_learning_rate()),
+                        batch_seed=int(self.batch_seed),
+                        plans={kind: self.get_epoch_planner(datasets, kind).epoch
+                               for kind in ['train', 'valid']},
+                        epoch_step=0, epoch_cost_sums=None, finished=finished)
+
+        # a run that was stopped (e.g. preempted) goes on from its last checkpoint
+        trainer_state = self.load_trainer_state(train_step)
+        if trainer_state is not None:
+            nepoch = trainer_state['nepoch']
+            nepoch_cnt = trainer_state['nepoch_cnt']
+            lve_epoch = trainer_state['lve_epoch']
+            valid_costs = trainer_state['valid_costs']
+            self.lve = trainer_state['lve']
+            smth_train_set_heldin_samp_cost, smth_train_set_heldout_samp_cost, \
+                smth_valid_set_heldin_samp_cost, smth_valid_set_heldout_samp_cost = \
+                trainer_state['smoothed_costs']
+            self.trial_recon_cost, self.samp_recon_cost = trainer_state['recon_costs']
+            self.learning_rate.load(trainer_state['learning_rate'], session)
+            # same batches as the run would have drawn
+            self.batch_seed = trainer_state['batch_seed']
+            self._epoch_planners = {}
+            for kind, plan in trainer_state['plans'].items():
+                self.get_epoch_planner(datasets, kind).epoch = plan
+            self.printlog("Resuming training at epoch %d, step %d (%d steps into the epoch)" % \
+                          (nepoch, train_step, trainer_state['epoch_step']))
         else:
-            self.lve = np.inf
-        #self.trial_recon_cost = valid_set_heldin_samp_cost
-        #self.samp_recon_cost = train_set_heldout_samp_cost
+            kl_weight, l2_weight = self.get_kl_l2_weights(nepoch)
+            # print validation costs before the first training step
+            val_total_cost, valid_set_heldin_samp_cost, valid_set_heldout_samp_cost, val_kl_cost, val_l2_cost ,_= \
+                self.do_validation(datasets,
+                                 kl_ic_weight=hps['kl_ic_weight'],
+                                 kl_co_weight=hps['kl_co_weight'],
+                                 dataset_type="valid",
+                                 kl_weight=kl_weight,
+                                 l2_weight=l2_weight)
+
+            self.printlog("Epoch:%d, step:%d (TRAIN, VALID): total: None, %.2f\
+            recon: None, %.2f, %.2f,    kl: None, %.2f, kl weight: %.2f" % \
+                  (nepoch-1, train_step, val_total_cost,
+                   valid_set_heldin_samp_cost, valid_set_heldout_samp_cost, val_kl_cost,
+                   kl_weight))
+
+            # pre-load the lve checkpoint (used in case of loaded checkpoint)
+            if target_num_epochs is not None and hps['checkpoint_pb_load_name'] == 'checkpoint_lve':
+                self.lve = valid_set_heldin_samp_cost
+            else:
+                self.lve = np.inf
+            #self.trial_recon_cost = valid_set_heldin_samp_cost
+            #self.samp_recon_cost = train_set_heldout_samp_cost
 
         coef = 0.7 # smoothing coefficient for valid cost - lower values mean more smoothing
         
@@ -1124,6 +1952,13 @@ class LFADS(object):
             # changed this to work based on Epochs (not steps)
             kl_weight, l2_weight = self.get_kl_l2_weights(nepoch)
 
+            # an epoch stopped part way is resumed at the step it was checkpointed
+            start_step, epoch_cost_sums = 0, None
+            if trainer_state is not None:
+                start_step, epoch_cost_sums = trainer_state['epoch_step'], trainer_state['epoch_cost_sums']
+                trainer_state = None
+            self._epoch_start_state = get_trainer_state()
+
             # CP/MRK: we no longer use these step-specific outputs
             # MRK, reverted the above, don't evaluate separately on training data (unless for testing) to save time
             # training cost is not used for anything that can affect the training
@@ -1132,7 +1967,10 @@ class LFADS(object):
                                  kl_ic_weight = hps['kl_ic_weight'],
                                  kl_co_weight = hps['kl_co_weight'],
                                  kl_weight=kl_weight,
-                                 l2_weight=l2_weight)
+                                 l2_weight=l2_weight,
+                                 start_step=start_step,
+                                 cost_sums=epoch_cost_sums)
+            self._epoch_start_state = None
             
             #tr_total_cost, train_set_heldin_samp_cost, train_set_heldout_samp_cost, tr_kl_cost, l2_cost, _ = \
             #    self.do_validation(datasets,
@@ -1292,6 +2130,11 @@ class LFADS(object):
                 valid_costs.append(valid_cost_to_use)
 
             nepoch += 1
+            # pairs with the checkpoint saved by train_epoch, if any
+            self.save_trainer_state(get_trainer_state())
+
+        # resuming from the last checkpoint would only stop again
+        self.save_trainer_state(get_trainer_state(finished=True))
           
 
     def eval_model_runs_batch(self, data_name, data_bxtxd, ext_input_bxtxi,
@@ -1341,13 +2184,19 @@ class LFADS(object):
         np_vals_flat = []
         for idx in batches:
             ext_inputs = ext_input_bxtxi[idx] if ext_input_bxtxi is not None else None
-            feed_dict = self.build_feed_dict(data_name, data_bxtxd[idx], cv_rand_mask=np.ones_like(data_bxtxd[idx]),
+            feed_dict = self.build_feed_dict(data_name, data_bxtxd[idx], cv_rand_mask=None,
                 ext_input_bxtxi=ext_inputs, run_type=run_type,
                                          keep_prob=1.0, keep_ratio=1.0, cv_keep_ratio=1.0)
             # flatten for sending into session.run
-            np_vals_flat.append(session.run(tf_vals, feed_dict=feed_dict))
+            np_vals_flat.append(self.run_step(kind_dict_key(run_type), tf_vals, feed_dict))
         # concatenate all the batches
         np_vals_flat = [np.concatenate([q[i] for q in np_vals_flat]) for i in range(len(np_vals_flat[0]))]
+        if self.session_idx is not None:
+            # drop the output_dist_params of the padded channels
+            out_dist_params = np_vals_flat[3]
+            np_vals_flat[3] = np.concatenate([out_dist_params[:, :, i:i + data_bxtxd.shape[2]]
+                                              for i in range(0, out_dist_params.shape[2], self.max_data_dim)],
+                                             axis=2)
         #np_vals_flat = [np.concatenate([q[i] for q in np_vals_flat]) for i in xrange(len(np_vals_flat[0]))]
         return np_vals_flat
     #        tf_vals_flat, fidxs = flatten(tf_vals)
@@ -1536,10 +2385,10 @@ class LFADS(object):
         """Calculate the R^2 between the true rates and LFADS output, over all
         trials and all channels
         """
-        true_flat = data_true.flatten()
-        est_flat = data_est.flatten()
+        true_flat = np.ravel(data_true)
+        est_flat = np.ravel(data_est)
         if mask is not None:
-            mask = mask.flatten()
+            mask = np.ravel(mask)
             mask = mask.astype(np.bool)
             R2_heldin = np.corrcoef(true_flat[mask], est_flat[mask])**2.0
             R2_heldout = np.corrcoef(true_flat[np.invert(mask)], est_flat[np.invert(mask)])**2.0
@@ -10,7 +10,8 @@ from lfads_tf1.customcells import GRUCell
 class BidirectionalDynamicRNN(object):
     def __init__(self, state_dim, batch_size, name, sequence_lengths,
                  inputs=None, initial_state=None, rnn_type='gru',
-                 clip_value = None, recurrent_collections = None):
+                 clip_value = None, recurrent_collections = None,
+                 reuse = None):
 
         if initial_state is None:
             # need initial states for fw and bw
@@ -61,21 +62,23 @@ class BidirectionalDynamicRNN(object):
         # pick your cell
         if rnn_type.lower() == 'lstm':
             self.cell_fw = tf.nn.rnn_cell.LSTMCell(num_units=state_dim,
-                                                state_is_tuple=True)
+                                                state_is_tuple=True, reuse=reuse)
             self.cell_bw = tf.nn.rnn_cell.LSTMCell(num_units=state_dim,
-                                                state_is_tuple=True)
+                                                state_is_tuple=True, reuse=reuse)
         elif rnn_type.lower() == 'gru':
-            self.cell_fw = tf.nn.rnn_cell.GRUCell(num_units=state_dim)
-            self.cell_bw = tf.nn.rnn_cell.GRUCell(num_units=state_dim)
+            self.cell_fw = tf.nn.rnn_cell.GRUCell(num_units=state_dim, reuse=reuse)
+            self.cell_bw = tf.nn.rnn_cell.GRUCell(num_units=state_dim, reuse=reuse)
 
         elif rnn_type.lower() == 'customgru':
             self.cell_fw = GRUCell(num_units = state_dim,
                                   clip_value = clip_value,
-                                  recurrent_collections = recurrent_collections
+                                  recurrent_collections = recurrent_collections,
+                                  reuse = reuse
                                   )
             self.cell_bw = GRUCell(num_units = state_dim,
                                   clip_value = clip_value,
-                                  recurrent_collections = recurrent_collections
+                                  recurrent_collections = recurrent_collections,
+                                  reuse = reuse
                                   )
         else:
             raise ValueError("Didn't understand rnn_type '%s'."%(rnn_type))
@@ -83,14 +86,38 @@ class BidirectionalDynamicRNN(object):
         if inputs is None:
             inputs = tf.zeros([batch_size, sequence_lengths, 1],
                               dtype=tf.float32)
-        self.states, self.last = tf.nn.bidirectional_dynamic_rnn(
-            cell_fw=self.cell_fw,
-            cell_bw=self.cell_bw,
-            dtype=tf.float32,
-            inputs=inputs,
-            initial_state_fw=self.init_fw,
-            initial_state_bw=self.init_bw,
-        )
+        if rnn_type.lower() == 'customgru':
+            # the input projections don't depend on the state, do them for
+            #  all timesteps before the loop. same scopes as
+            #  tf.nn.bidirectional_dynamic_rnn, so the variable names match
+            with tf.variable_scope('bidirectional_rnn'):
+                with tf.variable_scope('fw') as fw_scope:
+                    states_fw, last_fw = tf.nn.dynamic_rnn(
+                        cell=self.cell_fw,
+                        dtype=tf.float32,
+                        inputs=self.cell_fw.project_inputs(inputs),
+                        initial_state=self.init_fw,
+                        scope=fw_scope,
+                    )
+                with tf.variable_scope('bw') as bw_scope:
+                    states_bw, last_bw = tf.nn.dynamic_rnn(
+                        cell=self.cell_bw,
+                        dtype=tf.float32,
+                        inputs=self.cell_bw.project_inputs(tf.reverse(inputs, axis=[1])),
+                        initial_state=self.init_bw,
+                        scope=bw_scope,
+                    )
+            self.states = (states_fw, tf.reverse(states_bw, axis=[1]))
+            self.last = (last_fw, last_bw)
+        else:
+            self.states, self.last = tf.nn.bidirectional_dynamic_rnn(
+                cell_fw=self.cell_fw,
+                cell_bw=self.cell_bw,
+                dtype=tf.float32,
+                inputs=inputs,
+                initial_state_fw=self.init_fw,
+                initial_state_bw=self.init_bw,
+            )
 
         # concatenate the outputs of the encoders (h only) into one vector
         self.last_fw, self.last_bw = self.last
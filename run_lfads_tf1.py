@@ -11,13 +11,14 @@ from lfads_tf1.models import LFADS
 import lfads_tf1.data_funcs as utils
 
 #lfadslite
-from lfads_tf1.helper_funcs import kind_dict, kind_dict_key
+from lfads_tf1.helper_funcs import kind_dict, kind_dict_key, graph_run_type
 
 
 ## need to implement:
 MAX_CKPT_TO_KEEP = 5
 MAX_CKPT_TO_KEEP_LVE = 5
 CKPT_SAVE_INTERVAL = 5
+CKPT_SAVE_STEPS = 0 # 0: checkpoints are saved at the end of epochs only
 CSV_LOG = "fitlog"
 OUTPUT_FILENAME_STEM = ""
 CHECKPOINT_PB_LOAD_NAME = "checkpoint"
@@ -37,6 +38,16 @@ IC_ENC_DIM = 128
 IC_ENC_SEG_LEN = 0 # default, non-causal modeling
 GEN_DIM = 200
 BATCH_SIZE = 128
+BATCH_SEED = -1 # -1: drawn from numpy's random state
+SHUFFLE_BUFFER_TRIALS = 0 # 0: fully random batches
+SHUFFLE_BLOCK_TRIALS = 0 # 0: the HDF5 chunk length along trials
+PREFETCH_BATCHES = 2
+INPUT_MODE = 'feed_dict' # 'feed_dict', 'tf_data' or 'device'
+COST_FETCH_STEPS = 0 # 0: once per epoch
+FUSED_TRAIN_STEPS = 0 # 0: one training step per session.run
+USE_STEP_CALLABLES = True
+SPECIALIZE_RUN_TYPE = False # True: posterior sampling/mean graphs run only their kind
+PREDRAW_CELL_NOISE = False
 LEARNING_RATE_INIT = 0.01
 LEARNING_RATE_DECAY_FACTOR = 0.95
 LEARNING_RATE_STOP = 0.00001
@@ -54,6 +65,12 @@ DO_TRAIN_READIN = True
 # lfadslite param -
 #     sets whether there is an "input_factors" layer (for multi-session data, or even if you want to reduce the dimensionality of a single session)
 IN_FACTORS_DIM = 0
+# multi-session read-in/read-out parameters:
+#     'case' - one set of variables per session, picked by dataset name (a batch is from one session)
+#     'stacked' - variables stacked by session index, picked per trial (data is zero-padded to the most channels)
+SESSION_PARAMS = 'case'
+# with 'stacked' session params, batches mix trials of all sessions
+MIX_SESSION_BATCHES = False
 
 
 # Calibrated just above the average value for the rnn synthetic data.
@@ -70,6 +87,12 @@ OUTPUT_DIST = 'poisson' # 'poisson' or 'gaussian'
 
 DATA_DIR = "/tmp/rnn_synth_data_v1.0/"
 DATA_FILENAME_STEM = "chaotic_rnn_inputs_g1p5"
+LAZY_LOAD_DATA = False
+DATA_LOAD_WORKERS = 1
+DATA_CACHE_DIR = "" # empty disables the prepared dataset cache
+DATA_CACHE_MAX_GB = 50.0
+COMPACT_COUNT_DATA = True
+SPARSE_DATA_MAX_DENSITY = 0.0 # 0 keeps the data dense
 LFADS_SAVE_DIR = "/tmp/lfads_chaotic_rnn_inputs_g1p5/lfadsOut/"
 CO_DIM = 1
 DO_CAUSAL_CONTROLLER = False
@@ -101,6 +124,8 @@ LOSS_SCALE = 1e4
 ADAM_EPSILON = 1e-8
 ADAM_BETA1 = 0.9
 ADAM_BETA2 = 0.999
+# only update the read-in/read-out parameters of the sessions a step uses
+LAZY_SESSION_ADAM = False
 
 # calculate R^2 if the truth rates are available
 DO_CALC_R2 = False
@@ -122,6 +147,24 @@ flags.DEFINE_boolean("allow_gpu_growth", True,
 flags.DEFINE_string("data_dir", DATA_DIR, "Data for training")
 flags.DEFINE_string("data_filename_stem", DATA_FILENAME_STEM,
                     "Filename stem for data dictionaries.")
+flags.DEFINE_boolean("lazy_load_data", LAZY_LOAD_DATA,
+                     "If true, memory-map the HDF5 data files (or read them \
+                     chunk by chunk) instead of loading them into RAM.")
+flags.DEFINE_integer("data_load_workers", DATA_LOAD_WORKERS,
+                     "Number of dataset files to read in parallel.")
+flags.DEFINE_string("data_cache_dir", DATA_CACHE_DIR,
+                    "Directory to cache the prepared datasets in (as \
+                    memory-mapped .npy files). Empty disables the cache.")
+flags.DEFINE_float("data_cache_max_gb", DATA_CACHE_MAX_GB,
+                   "Size cap of the dataset cache, least recently used \
+                   entries are removed first (0 for no cap).")
+flags.DEFINE_boolean("compact_count_data", COMPACT_COUNT_DATA,
+                     "Keep integer-valued data (spike counts) as uint8/uint16 \
+                     in memory and cast it to float32 in the graph.")
+flags.DEFINE_float("sparse_data_max_density", SPARSE_DATA_MAX_DENSITY,
+                   "Store the train/valid data sparse if at most this fraction \
+                   of its bins are nonzero (0 to always keep it dense). Only \
+                   the current batch is made dense, on the device.")
 flags.DEFINE_string("lfads_save_dir", LFADS_SAVE_DIR, "model save dir")
 flags.DEFINE_string("checkpoint_pb_load_name", CHECKPOINT_PB_LOAD_NAME,
                     "Name of checkpoint files, use 'checkpoint_lve' for best \
@@ -147,6 +190,10 @@ flags.DEFINE_integer("max_ckpt_to_keep_lve", MAX_CKPT_TO_KEEP_LVE,
 
 flags.DEFINE_integer("ckpt_save_interval", CKPT_SAVE_INTERVAL,
                  "Number of epochs between saving (non-lve) checkpoints")
+flags.DEFINE_integer("ckpt_save_steps", CKPT_SAVE_STEPS,
+                 "Also save a (non-lve) checkpoint every this many training \
+                 steps within an epoch, so that a preempted run resumes from \
+                 there. 0 to save at the end of epochs only.")
 
 
 # GENERATION
@@ -166,6 +213,13 @@ flags.DEFINE_integer("factors_dim", FACTORS_DIM,
 # This is critical for multi-session data, where the encoders must see a consistent input dimensionality across sessions
 flags.DEFINE_integer("in_factors_dim", IN_FACTORS_DIM,
                      "Number of 'input factors' (encoders read from these)")
+flags.DEFINE_string("session_params", SESSION_PARAMS,
+                    "Per-session read-in/read-out parameters: 'case' (picked \
+                    by dataset name) or 'stacked' (stacked by session index, \
+                    picked per trial).")
+flags.DEFINE_boolean("mix_session_batches", MIX_SESSION_BATCHES,
+                     "Batches mix trials of all sessions. Needs \
+                     session_params 'stacked' and input_mode 'feed_dict'.")
 flags.DEFINE_integer("ic_enc_dim", IC_ENC_DIM,
                      "Cell hidden size, encoder of h0")
 flags.DEFINE_integer("ic_enc_seg_len", IC_ENC_SEG_LEN,
@@ -280,6 +334,51 @@ flags.DEFINE_integer("batch_size", BATCH_SIZE,
                      "Batch size to use during training.")
 flags.DEFINE_integer("valid_batch_size", None,
                      "Batch size to use during validation.")
+flags.DEFINE_integer("batch_seed", BATCH_SEED,
+                     "Seed of the order of the batches in each epoch (-1 to \
+                     draw one from numpy's random state).")
+flags.DEFINE_integer("shuffle_buffer_trials", SHUFFLE_BUFFER_TRIALS,
+                     "For data larger than memory (lazy_load_data): if > 0, \
+                     shuffle blocks of trials, then trials within a buffer \
+                     of this many trials, and read the buffers from disk \
+                     ahead of training.")
+flags.DEFINE_integer("shuffle_block_trials", SHUFFLE_BLOCK_TRIALS,
+                     "Trials per shuffle block with shuffle_buffer_trials \
+                     (0 for the HDF5 chunk length, or batch_size if the data \
+                     is not chunked).")
+flags.DEFINE_integer("prefetch_batches", PREFETCH_BATCHES,
+                     "Number of batches to assemble ahead of training in a \
+                     background thread (0 to assemble each batch in turn).")
+flags.DEFINE_string("input_mode", INPUT_MODE,
+                    "How training batches get into the graph: 'feed_dict' \
+                    (fed each step), 'tf_data' (a tf.data pipeline with a \
+                    parallel map and prefetch) or 'device' (the datasets are \
+                    uploaded to the device once and only trial indices are \
+                    fed, for data that fits in device memory). Evaluation \
+                    always feeds.")
+flags.DEFINE_integer("cost_fetch_steps", COST_FETCH_STEPS,
+                     "Training costs are summed in the graph; read and log \
+                     their running mean every this many steps (0 to only \
+                     read them at the end of the epoch).")
+flags.DEFINE_integer("fused_train_steps", FUSED_TRAIN_STEPS,
+                     "With input_mode 'device', run up to this many training \
+                     steps per session.run, in a tf.while_loop over the \
+                     trial indices of their batches (0 or 1 for one step per \
+                     session.run). Ignored with the other input modes.")
+flags.DEFINE_boolean("use_step_callables", USE_STEP_CALLABLES,
+                     "Run training and evaluation steps through cached \
+                     Session.make_callable's instead of session.run.")
+flags.DEFINE_boolean("specialize_run_type", SPECIALIZE_RUN_TYPE,
+                     "Build posterior sampling and posterior mean graphs for \
+                     the run type of the kind only (always sampling the \
+                     posteriors, or always taking their means) instead of \
+                     choosing between them with a tf.cond at every step. \
+                     Such a graph can't run the other run type. Training \
+                     graphs are not specialized.")
+flags.DEFINE_boolean("predraw_cell_noise", PREDRAW_CELL_NOISE,
+                     "Draw the generator/controller dropout masks and the \
+                     controller output noise for all timesteps before the \
+                     recurrence, instead of at every step in the loop.")
 flags.DEFINE_float("learning_rate_init", LEARNING_RATE_INIT,
                    "Learning rate initial value")
 flags.DEFINE_float("learning_rate_decay_factor", LEARNING_RATE_DECAY_FACTOR,
@@ -384,6 +483,10 @@ flags.DEFINE_float("adam_beta1", ADAM_BETA1,
                    "Beta1 parameter of ADAM optimizer.")
 flags.DEFINE_float("adam_beta2", ADAM_BETA2,
                    "Beta2 parameter of ADAM optimizer.")
+flags.DEFINE_boolean("lazy_session_adam", LAZY_SESSION_ADAM,
+                     "Apply ADAM updates to the read-in/read-out parameters \
+                     of the sessions in the batch only, leaving the other \
+                     sessions' parameters and moments as they are.")
 
 flags.DEFINE_boolean("do_calc_r2", DO_CALC_R2,
                      "Calculate R^2 is the truth rates are available.")
@@ -405,7 +508,8 @@ def build_model(hps, datasets=None):
   """
 
   with tf.variable_scope("LFADS", reuse=None):
-    model = LFADS(hps, datasets=datasets)
+    # the graph is built for the run type of hps.kind
+    model = LFADS(hps, datasets=datasets, run_type=graph_run_type(hps))
 
   if not os.path.exists(hps.lfads_save_dir):
     print("Save directory %s does not exist, creating it." % hps.lfads_save_dir)
@@ -506,8 +610,15 @@ def build_hyperparameter_dict(flags):
   d['max_ckpt_to_keep'] = flags.max_ckpt_to_keep
   d['max_ckpt_to_keep_lve'] = flags.max_ckpt_to_keep_lve
   d['ckpt_save_interval'] = flags.ckpt_save_interval
+  d['ckpt_save_steps'] = flags.ckpt_save_steps
   d['ps_nexamples_to_process'] = flags.ps_nexamples_to_process
   d['data_filename_stem'] = flags.data_filename_stem
+  d['lazy_load_data'] = flags.lazy_load_data
+  d['data_load_workers'] = flags.data_load_workers
+  d['data_cache_dir'] = flags.data_cache_dir
+  d['data_cache_max_gb'] = flags.data_cache_max_gb
+  d['compact_count_data'] = flags.compact_count_data
+  d['sparse_data_max_density'] = flags.sparse_data_max_density
   d['device'] = flags.device
   d['csv_log'] = flags.csv_log
   # Generation
@@ -519,6 +630,8 @@ def build_hyperparameter_dict(flags):
 
   #lfadslite
   d['in_factors_dim'] = flags.in_factors_dim
+  d['session_params'] = flags.session_params
+  d['mix_session_batches'] = flags.mix_session_batches
 
   # KL distributions
   d['ic_prior_var'] = flags.ic_prior_var
@@ -541,6 +654,16 @@ def build_hyperparameter_dict(flags):
   # Optimization
   d['batch_size'] = flags.batch_size
   d['valid_batch_size'] = flags.batch_size if flags.valid_batch_size is None else flags.valid_batch_size
+  d['batch_seed'] = flags.batch_seed
+  d['shuffle_buffer_trials'] = flags.shuffle_buffer_trials
+  d['shuffle_block_trials'] = flags.shuffle_block_trials
+  d['prefetch_batches'] = flags.prefetch_batches
+  d['input_mode'] = flags.input_mode
+  d['cost_fetch_steps'] = flags.cost_fetch_steps
+  d['fused_train_steps'] = flags.fused_train_steps
+  d['use_step_callables'] = flags.use_step_callables
+  d['specialize_run_type'] = flags.specialize_run_type
+  d['predraw_cell_noise'] = flags.predraw_cell_noise
   d['learning_rate_init'] = flags.learning_rate_init
   d['learning_rate_decay_factor'] = flags.learning_rate_decay_factor
   d['learning_rate_stop'] = flags.learning_rate_stop
@@ -581,6 +704,7 @@ def build_hyperparameter_dict(flags):
   d['adam_epsilon'] = flags.adam_epsilon
   d['beta1'] = flags.adam_beta1
   d['beta2'] = flags.adam_beta2
+  d['lazy_session_adam'] = flags.lazy_session_adam
 
   d['do_calc_r2'] = flags.do_calc_r2
   
@@ -766,9 +890,12 @@ def main(_):
   train_set = valid_set = None
   if hps.kind in [kind_dict("train"),
                   kind_dict("posterior_sample_and_average"),
-                  kind_dict("prior_sample"),
-                  kind_dict("write_model_params")]:
+                  kind_dict("prior_sample")]:
     datasets = utils.load_datasets(hps.data_dir, hps.data_filename_stem, hps)
+  elif hps.kind == kind_dict("write_model_params"):
+    # only the shapes and alignment matrices are needed to build the graph
+    datasets = utils.load_datasets(hps.data_dir, hps.data_filename_stem, hps,
+                                   keys=utils.ALIGNMENT_KEYS)
   else:
     raise ValueError('Kind {} is not supported.'.format(kind))
 